@@ -1,4 +1,4 @@
-__all__ = ["login_not_required"]
+__all__ = ["BaseChoiceIterator", "login_not_required"]
 
 
 try:
@@ -11,3 +11,10 @@ except ImportError:
         """
         view_func.login_required = False
         return view_func
+
+
+try:
+    from django.utils.choices import BaseChoiceIterator
+except ImportError:
+    # For Django < 5.0, choices are not normalized and therefore stay lazy
+    BaseChoiceIterator = object
@@ -0,0 +1,110 @@
+import time
+from functools import cache, wraps
+
+import requests
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from requests.adapters import HTTPAdapter
+
+
+# Connect and read timeout in seconds
+DEFAULT_TIMEOUT = (3.05, 10)
+
+_breakers = {}
+
+
+class ProviderUnavailableError(Exception):
+    pass
+
+
+@cache
+def _adapter():
+    size = getattr(settings, "AUTHLIB_HTTP_POOL_SIZE", 10)
+    return HTTPAdapter(pool_connections=size, pool_maxsize=size)
+
+
+@receiver(setting_changed)
+def _reset_adapter(*, setting, **kwargs):
+    if setting == "AUTHLIB_HTTP_POOL_SIZE":
+        _adapter.cache_clear()
+
+
+def _timeout(provider):
+    timeouts = getattr(settings, "AUTHLIB_PROVIDER_TIMEOUTS", {})
+    return timeouts.get(provider, timeouts.get("default", DEFAULT_TIMEOUT))
+
+
+def _breaker_settings():
+    return {"failures": 5, "cooldown": 30} | getattr(
+        settings, "AUTHLIB_CIRCUIT_BREAKER", {}
+    )
+
+
+def _breaker_cache():
+    alias = getattr(settings, "AUTHLIB_CIRCUIT_BREAKER_CACHE", None)
+    return None if alias is None else caches[alias]
+
+
+def _breaker_state(provider):
+    if (cache := _breaker_cache()) is not None:
+        return cache.get(f"authlib-breaker-{provider}", (0, 0))
+    return _breakers.get(provider, (0, 0))
+
+
+def _record(provider, *, failed):
+    failures, _open_until = _breaker_state(provider)
+    if not failed and not failures:
+        return
+    config = _breaker_settings()
+    failures = failures + 1 if failed else 0
+    state = (
+        failures,
+        time.time() + config["cooldown"] if failures >= config["failures"] else 0,
+    )
+    if (cache := _breaker_cache()) is not None:
+        cache.set(f"authlib-breaker-{provider}", state, config["cooldown"] * 10)
+    else:
+        _breakers[provider] = state
+
+
+def _guarded(request, provider):
+    @wraps(request)
+    def fn(method, url, **kwargs):
+        if _breaker_state(provider)[1] > time.time():
+            raise ProviderUnavailableError(f"{provider} is temporarily unavailable")
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = _timeout(provider)
+        try:
+            response = request(method, url, **kwargs)
+        except requests.RequestException:
+            _record(provider, failed=True)
+            raise
+        _record(provider, failed=response.status_code >= 500)
+        return response
+
+    return fn
+
+
+def pooled(session, *, provider=None):
+    """
+    Mounts the process-wide connection pool on a ``requests`` session
+
+    Sessions are still created per login so that OAuth state and tokens
+    aren't shared, but connections to the providers are kept alive and
+    reused across sessions and threads.
+
+    If ``provider`` is given requests use the timeouts configured in
+    ``AUTHLIB_PROVIDER_TIMEOUTS`` and are guarded by a circuit breaker:
+    After ``failures`` consecutive connection errors or server errors, all
+    requests fail with ``ProviderUnavailableError`` for ``cooldown`` seconds
+    (configured using ``AUTHLIB_CIRCUIT_BREAKER``). The breaker state is kept
+    in process or in the cache named by ``AUTHLIB_CIRCUIT_BREAKER_CACHE``.
+    """
+    adapter = _adapter()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if provider:
+        session.request = _guarded(session.request, provider)
+    return session
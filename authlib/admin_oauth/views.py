@@ -8,6 +8,7 @@ from django.utils.module_loading import import_string
 from django.utils.translation import gettext as _
 from django.views.decorators.cache import never_cache
 
+from authlib.base_user import _users_by_email
 from authlib.google import GoogleOAuth2Client
 from authlib.views import retrieve_next, set_next_cookie
 
@@ -86,7 +87,7 @@ def admin_oauth(request):
 
 def create_superuser(request, email):
     user_model = auth.get_user_model()
-    if user_model.objects.filter(email=email).exists() is False:
+    if _users_by_email(email).exists() is False:
         user = user_model(email=email, is_active=True, is_staff=True, is_superuser=True)
         if user.USERNAME_FIELD != "email":
             setattr(user, user.USERNAME_FIELD, email)
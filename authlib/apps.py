@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class AuthlibConfig(AppConfig):
+    name = "authlib"
+
+    def ready(self):
+        # Connect the signal handlers invalidating cached permissions
+        from authlib import backends  # noqa: F401
@@ -1,10 +1,49 @@
-from functools import cache
+import hashlib
+import time
+from functools import cache, lru_cache, partial
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth.models import Permission
+from django.core.cache import caches
 from django.core.exceptions import PermissionDenied
-from django.db.models import ObjectDoesNotExist
+from django.core.signals import setting_changed
+from django.db import router, transaction
+from django.db.models import ObjectDoesNotExist, Q
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.dispatch import receiver
+from django.utils.functional import cached_property
+
+from authlib.base_user import _users_by_email
+from authlib.roles import _role_callback, _roles, _roles_version
+
+
+@cache
+def _user_cache():
+    alias = getattr(settings, "AUTHLIB_USER_CACHE", None)
+    return None if alias is None else caches[alias]
+
+
+def _user_cache_key(user_model, pk):
+    return f"authlib-user-{user_model._meta.label_lower}-{pk}"
+
+
+@receiver(setting_changed)
+def _reset_user_cache(*, setting, **kwargs):
+    if setting == "AUTHLIB_USER_CACHE":
+        _user_cache.cache_clear()
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def _invalidate_user_cache(sender, instance, using, **kwargs):
+    if (user_cache := _user_cache()) is not None:
+        key = _user_cache_key(sender, instance.pk)
+        user_cache.delete(key)
+        # Other requests may cache the old row again until the transaction
+        # has been committed
+        transaction.on_commit(partial(user_cache.delete, key), using=using)
 
 
 class EmailBackend(ModelBackend):
@@ -15,27 +54,307 @@ class EmailBackend(ModelBackend):
             return None
 
     def get_user(self, user_id):
-        return self._get_user(pk=user_id)
+        """
+        Return the active user with the primary key ``user_id``
+
+        If ``AUTHLIB_USER_CACHE`` names a cache, the fields listed in
+        ``AUTHLIB_USER_CACHE_FIELDS`` (default: all fields) are cached for
+        ``AUTHLIB_USER_CACHE_TIMEOUT`` seconds (default: 300). Saving or
+        deleting the user invalidates the cache entry.
+        """
+        if (user_cache := _user_cache()) is None:
+            return self._get_user(pk=user_id)
+
+        user_model = get_user_model()
+        key = _user_cache_key(user_model, user_id)
+        # from_db() expects the values in the order of the concrete fields
+        if data := user_cache.get(key):
+            fields = [
+                f.attname for f in user_model._meta.concrete_fields if f.attname in data
+            ]
+            return user_model.from_db(
+                router.db_for_read(user_model),
+                fields,
+                [data[field] for field in fields],
+            )
+
+        if user := self._get_user(pk=user_id):
+            cached = getattr(settings, "AUTHLIB_USER_CACHE_FIELDS", None)
+            fields = [
+                f.attname
+                for f in user_model._meta.concrete_fields
+                if not cached or f.primary_key or f.attname in cached
+            ]
+            user_cache.set(
+                key,
+                {field: getattr(user, field) for field in fields},
+                timeout=getattr(settings, "AUTHLIB_USER_CACHE_TIMEOUT", 300),
+            )
+        return user
 
     def authenticate(self, request, email):
-        return self._get_user(email=email)
+        try:
+            return _users_by_email(email).get(is_active=True)
+        except ObjectDoesNotExist:
+            return None
+
+
+_all_perms_cache = {}
+_role_matrix = {}
+_generation = {"local": 0, "shared": None, "checked": None, "roles": None}
+GENERATION_KEY = "authlib-perms-generation"
 
 
 @cache
-def _all_perms():
-    queryset = Permission.objects.values_list("content_type__app_label", "codename")
-    return [f"{app_label}.{codename}" for app_label, codename in queryset]
+def _permissions_cache():
+    alias = getattr(settings, "AUTHLIB_PERMISSIONS_CACHE", None)
+    return None if alias is None else caches[alias]
+
+
+@lru_cache(maxsize=1)
+def _roles_fingerprint(version):
+    """
+    Return a hash of the role callbacks which is stable across processes
+    """
+
+    def fingerprint(value):
+        if isinstance(value, partial):
+            return [
+                fingerprint(value.func),
+                fingerprint(value.args),
+                fingerprint(value.keywords),
+            ]
+        if isinstance(value, dict):
+            return sorted((repr(k), fingerprint(v)) for k, v in value.items())
+        if isinstance(value, (set, frozenset)):
+            return sorted(repr(fingerprint(v)) for v in value)
+        if isinstance(value, (list, tuple)):
+            return [fingerprint(v) for v in value]
+        if callable(value) and hasattr(value, "__qualname__"):
+            return f"{value.__module__}.{value.__qualname__}"
+        return repr(value)
+
+    callbacks = {role: cfg.get("callback") for role, cfg in _roles().items()}
+    return hashlib.md5(repr(fingerprint(callbacks)).encode()).hexdigest()
+
+
+def _reset_local():
+    _generation["local"] += 1
+    _all_perms_cache.clear()
+    _role_matrix.clear()
+
+
+@receiver(setting_changed)
+def _reset_role_matrix(*, setting, **kwargs):
+    if setting in {"AUTHLIB_ROLES", "AUTHLIB_PERMISSIONS_CACHE"}:
+        _permissions_cache.cache_clear()
+        _reset_local()
+        _generation.update(shared=None, checked=None)
+
+
+def _sync_generation(shared):
+    """
+    Drop the caches of this process when the shared generation changed
+
+    The shared cache is consulted at most every
+    ``AUTHLIB_PERMISSIONS_CACHE_INTERVAL`` seconds.
+    """
+    now = time.monotonic()
+    interval = getattr(settings, "AUTHLIB_PERMISSIONS_CACHE_INTERVAL", 10)
+    if _generation["checked"] is None or now - _generation["checked"] >= interval:
+        shared.add(GENERATION_KEY, time.time_ns(), timeout=None)
+        if (value := shared.get(GENERATION_KEY)) != _generation["shared"]:
+            _reset_local()
+        _generation.update(shared=value, checked=now)
+    return _generation["shared"]
+
+
+def invalidate_permissions():
+    """
+    Discard the list of permissions and computed role permissions in this and
+    (when using the shared cache) all other processes
+    """
+    if (shared := _permissions_cache()) is not None:
+        shared.set(GENERATION_KEY, time.time_ns(), timeout=None)
+    _reset_local()
+    _generation.update(shared=None, checked=None)
+
+
+@receiver(post_migrate)
+@receiver(post_save, sender=Permission)
+@receiver(post_delete, sender=Permission)
+def _invalidate_permissions_on_change(*, using, **kwargs):
+    # Other processes must not cache the old permissions under the new
+    # generation
+    transaction.on_commit(invalidate_permissions, using=using)
+
+
+def _all_perms(using=None):
+    """
+    Return a dict mapping all permissions as ``app_label.codename`` strings to
+    the name of their model
+
+    The result is cached per database alias until the permissions are
+    invalidated.
+    """
+    using = using or router.db_for_read(Permission)
+    key = (using, _generation["local"])
+    if (perms := _all_perms_cache.get(key)) is None:
+        queryset = Permission.objects.using(using).values_list(
+            "content_type__app_label", "content_type__model", "codename"
+        )
+        perms = _all_perms_cache[key] = {
+            f"{app_label}.{codename}": model for app_label, model, codename in queryset
+        }
+    return perms
+
+
+def _index_by_model(perms, models):
+    by_model = {}
+    for perm in perms:
+        if model := models.get(perm):
+            app_label, _sep, codename = perm.partition(".")
+            action = codename.removesuffix(f"_{model}")
+            by_model.setdefault(app_label, {}).setdefault(model, set()).add(action)
+    return {
+        app: {model: frozenset(actions) for model, actions in app_models.items()}
+        for app, app_models in by_model.items()
+    }
+
+
+class _RolePermissions:
+    """
+    The permissions granted and denied by a role
+
+    Permissions are evaluated one at a time when checked and the result is
+    memoized. All permissions are only evaluated when the complete set or one
+    of the indexes is requested, which requires calling ``evaluate`` first.
+
+    The instance is shared between all users with the same role, so the user
+    checking a permission is passed to the callback but not kept around.
+    """
+
+    def __init__(self, callback, models):
+        self._callback = callback
+        self._models = models
+        self._decisions = {}
+        self._modules = {}
+        self._complete = False
+
+    def __getstate__(self):
+        # The callback cannot be pickled, callers evaluate everything first
+        self.by_app  # noqa: B018
+        self.by_model  # noqa: B018
+        state = self.__dict__.copy()
+        state.update(_callback=None)
+        return state
+
+    def decide(self, perm, user):
+        """
+        Return ``True`` if the role grants ``perm``, ``None`` if it explicitly
+        denies it and ``False`` otherwise
+        """
+        if (decision := self._decisions.get(perm, ...)) is not ...:
+            return decision
+        decision = False
+        if self._callback:
+            try:
+                decision = bool(self._callback(user=user, perm=perm, obj=None))
+            except PermissionDenied:
+                decision = None
+        self._decisions[perm] = decision
+        return decision
+
+    def evaluate(self, user):
+        if not self._complete:
+            for perm in self._models:
+                self.decide(perm, user)
+            self._complete = True
+        return self
+
+    def has_module(self, app_label, user):
+        if "by_app" in self.__dict__:
+            return app_label in self.by_app
+        if (result := self._modules.get(app_label)) is None:
+            prefix = f"{app_label}."
+            result = self._modules[app_label] = any(
+                self.decide(perm, user)
+                for perm in self._models
+                if perm.startswith(prefix)
+            )
+        return result
+
+    @cached_property
+    def allowed(self):
+        return frozenset(perm for perm in self._models if self._decisions.get(perm))
+
+    @cached_property
+    def denied(self):
+        return frozenset(
+            perm
+            for perm in self._models
+            if perm in self._decisions and self._decisions[perm] is None
+        )
+
+    @cached_property
+    def by_app(self):
+        by_app = {}
+        for perm in self.allowed:
+            app_label, _sep, codename = perm.partition(".")
+            by_app.setdefault(app_label, set()).add(codename)
+        return {app: frozenset(codenames) for app, codenames in by_app.items()}
+
+    @cached_property
+    def by_model(self):
+        return _index_by_model(self.allowed, self._models)
+
+
+def _role_permissions(user):
+    """
+    Return the ``_RolePermissions`` instance for the role of ``user``
+
+    Without an object, permissions only depend on the role (and on
+    ``is_active``, which is checked by the callers). The permissions are
+    therefore evaluated once per role and shared between all user instances;
+    role callbacks must not depend on the user when ``obj`` is ``None``.
+    If ``AUTHLIB_PERMISSIONS_CACHE`` names a cache the permissions are
+    evaluated completely and also shared between processes.
+    """
+    if (shared := _permissions_cache()) is not None:
+        generation = _sync_generation(shared)
+    if (version := _roles_version()) != _generation["roles"]:
+        # The role registry has been rebuilt
+        _reset_local()
+        _generation["roles"] = version
+    role = user._role
+    using = router.db_for_read(Permission)
+    key = (using, _generation["local"], role)
+    if (perms := _role_matrix.get(key)) is None:
+        perms = _RolePermissions(_role_callback(role), _all_perms(using))
+        if shared is not None:
+            digest = hashlib.md5(
+                f"{using}:{role}:{_roles_fingerprint(_roles_version())}".encode()
+            ).hexdigest()
+            shared_key = f"authlib-perms-{digest}-{generation}"
+            if (cached := shared.get(shared_key)) is None:
+                shared.set(shared_key, perms.evaluate(user))
+            else:
+                perms = cached
+        _role_matrix[key] = perms
+    return perms
 
 
 class PermissionsBackend(ModelBackend):
     def get_user_permissions(self, user, obj=None):
-        attribute = "_user_permissions_cache"
-        if not hasattr(user, attribute):
-            # ModelBackend can use an optimized variant of this -- we cannot since
-            # we don't know what the permission checking callbacks do.
-            perms = {perm for perm in _all_perms() if self._has_perm(user, perm, obj)}
-            setattr(user, attribute, perms)
-        return getattr(user, attribute)
+        if not user.is_active:
+            return frozenset()
+        if obj is None:
+            if user.is_superuser:
+                return _all_perms().keys()
+            return _role_permissions(user).evaluate(user).allowed
+        # ModelBackend can use an optimized variant of this -- we cannot since
+        # we don't know what the permission checking callbacks do.
+        return {perm for perm in _all_perms() if self._has_perm(user, perm, obj)}
 
     def _has_perm(self, user, perm, obj):
         try:
@@ -50,17 +369,63 @@ class PermissionsBackend(ModelBackend):
         return self.get_user_permissions(user, obj=obj)
 
     def has_perm(self, user, perm, obj=None):
+        if obj is None:
+            if not user.is_active:
+                return False
+            if perm in _all_perms():
+                if (decision := _role_permissions(user).decide(perm, user)) is None:
+                    raise PermissionDenied
+                return decision
         return user._role_has_perm(perm=perm, obj=obj)
 
     def has_module_perms(self, user_obj, app_label):
         """
         Return True if user_obj has any permissions in the given app_label.
         """
-        return user_obj.is_active and any(
-            perm[: perm.index(".")] == app_label
-            for perm in self.get_all_permissions(user_obj)
+        if not user_obj.is_active:
+            return False
+        return user_obj.is_superuser or _role_permissions(user_obj).has_module(
+            app_label, user_obj
         )
 
-    # def with_perm(self, perm, is_active=True, include_superusers=True, obj=None):
+    def get_permissions_by_app(self, user_obj):
+        """
+        Return the permissions of ``user_obj`` as a ``{app_label: {model_name:
+        actions}}`` dict, e.g. ``{"sessions": {"session": {"view", "change"}}}``
+
+        This allows rendering e.g. the admin index without having to check
+        each permission separately.
+        """
+        if not user_obj.is_active:
+            return {}
+        if user_obj.is_superuser:
+            models = _all_perms()
+            return _index_by_model(models, models)
+        return _role_permissions(user_obj).evaluate(user_obj).by_model
+
+    def with_perm(self, perm, is_active=True, include_superusers=True, obj=None):  # noqa: FBT002
+        """
+        Return users which have permission ``perm`` through their role
+        """
+        user_model = get_user_model()
+        if isinstance(perm, Permission):
+            perm = f"{perm.content_type.app_label}.{perm.codename}"
+        elif not isinstance(perm, str):
+            raise TypeError(
+                "The `perm` argument must be a string or a permission instance."
+            )
+        if obj is not None or not hasattr(user_model, "_role_field"):
+            return user_model._default_manager.none()
 
-    # The user model and its manager will delegate permission lookup functions (get_user_permissions(), get_group_permissions(), get_all_permissions(), has_perm(), has_module_perms(), and with_perm()) to any authentication backend that implements these functions.
+        field = user_model._role_field
+        roles = [
+            role
+            for role in _roles()
+            if self._has_perm(user_model(**{field: role}), perm, None)
+        ]
+        user_q = Q(**{f"{field}__in": roles})
+        if include_superusers:
+            user_q |= Q(is_superuser=True)
+        if is_active is not None:
+            user_q &= Q(is_active=is_active)
+        return user_model._default_manager.filter(user_q)
@@ -1,10 +1,22 @@
-from django.contrib.auth import models as auth_models
+from django.contrib.auth import get_user_model, models as auth_models
 from django.db import models
+from django.db.models.functions import Lower
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 
 class BaseUserManager(auth_models.BaseUserManager):
+    def filter_by_email(self, email):
+        """
+        Return users with the email address ``email``, ignoring case
+
+        The lookup uses the index on ``Lower("email")``.
+        """
+        return self.alias(email_lower=Lower("email")).filter(email_lower=email.lower())
+
+    def get_by_natural_key(self, username):
+        return self.filter_by_email(username).get()
+
     def create_user(self, email, password=None):
         if not email:
             raise ValueError("Email missing")
@@ -20,6 +32,8 @@ class BaseUserManager(auth_models.BaseUserManager):
         user.save(using=self._db)
         return user
 
+    with_perm = auth_models.UserManager.with_perm
+
 
 class BaseUser(auth_models.AbstractBaseUser, auth_models.PermissionsMixin):
     EMAIL_FIELD = "email"
@@ -39,6 +53,11 @@ class BaseUser(auth_models.AbstractBaseUser, auth_models.PermissionsMixin):
 
     class Meta:
         abstract = True
+        constraints = [
+            models.UniqueConstraint(
+                Lower("email"), name="%(app_label)s_%(class)s_email_ci"
+            ),
+        ]
         verbose_name = _("user")
         verbose_name_plural = _("users")
 
@@ -50,3 +69,16 @@ class BaseUser(auth_models.AbstractBaseUser, auth_models.PermissionsMixin):
 
     def get_short_name(self):
         return self.email
+
+
+def _users_by_email(email):
+    """
+    Return a queryset of users with the email address ``email``
+
+    The lookup is case-insensitive if the user model's manager supports it
+    (e.g. the ``BaseUserManager``).
+    """
+    manager = get_user_model()._default_manager
+    if hasattr(manager, "filter_by_email"):
+        return manager.filter_by_email(email)
+    return manager.filter(email=email)
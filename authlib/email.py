@@ -1,18 +1,71 @@
 import binascii
-import contextlib
-
+import hashlib
+import hmac
+import logging
+import secrets
+import struct
+import time
+from contextlib import suppress
+from functools import cache
+from itertools import islice
+
+from asgiref.local import Local
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core import signing
+from django.core.cache import caches
 from django.core.exceptions import ValidationError
-from django.core.mail import EmailMultiAlternatives
-from django.template.loader import TemplateDoesNotExist, render_to_string
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.signals import request_finished, request_started, setting_changed
+from django.dispatch import receiver
+from django.template.loader import TemplateDoesNotExist, select_template
 from django.urls import reverse
-from django.utils.translation import gettext as _
+from django.utils.encoding import force_bytes
+from django.utils.translation import get_language, gettext as _
 
 
 # Assumes that this is a model with an unique `email` field.
 User = get_user_model()
 
+_templates = {}
+# Version and timestamp of compact codes
+_COMPACT_HEADER = struct.Struct(">BI")
+_COMPACT_MAC_LENGTH = 16
+# Payloads longer than this are stored in AUTHLIB_CODE_PAYLOAD_CACHE
+_PAYLOAD_MAX_LENGTH = 32
+_deferred = Local()
+logger = logging.getLogger(__name__)
+
+
+@receiver(setting_changed)
+def _reset_templates(*, setting, **kwargs):
+    if setting in {"TEMPLATES", "DEBUG"}:
+        _templates.clear()
+    elif setting in {"SECRET_KEY", "SECRET_KEY_FALLBACKS"}:
+        _signers.cache_clear()
+
+
+def _load_template(names):
+    try:
+        return select_template(names)
+    except TemplateDoesNotExist:
+        return None
+
+
+def _select_template(names):
+    """
+    Return the first existing template of ``names`` or ``None``
+
+    Results, including missing templates, are cached per list of template
+    names and active language unless ``DEBUG`` is enabled.
+    """
+    if settings.DEBUG:
+        return _load_template(names)
+    key = (tuple(names), get_language())
+    if key not in _templates:
+        _templates[key] = _load_template(names)
+    return _templates[key]
+
 
 def render_to_mail(template, context, **kwargs):
     """
@@ -38,12 +91,10 @@ def render_to_mail(template, context, **kwargs):
     """
     if not isinstance(template, (list, tuple)):
         template = [template]
-    lines = iter(
-        line.rstrip()
-        for line in render_to_string(
-            [f"{t}.txt" for t in template], context
-        ).splitlines()
-    )
+    names = [f"{t}.txt" for t in template]
+    if (text := _select_template(names)) is None:
+        raise TemplateDoesNotExist(", ".join(names))
+    lines = iter(line.rstrip() for line in text.render(context).splitlines())
 
     subject = ""
     try:
@@ -58,20 +109,110 @@ def render_to_mail(template, context, **kwargs):
     body = "\n".join(lines).strip("\n")
     message = EmailMultiAlternatives(subject=subject, body=body, **kwargs)
 
-    with contextlib.suppress(TemplateDoesNotExist):
-        message.attach_alternative(
-            render_to_string([f"{t}.html" for t in template], context), "text/html"
-        )
+    if html := _select_template([f"{t}.html" for t in template]):
+        message.attach_alternative(html.render(context), "text/html")
 
     return message
 
 
+class _Signer(signing.TimestampSigner):
+    """
+    ``TimestampSigner`` deriving the HMAC keys only once
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        hasher = getattr(hashlib, self.algorithm)
+        salt = force_bytes(self.salt + "signer")
+        self._hmacs = {
+            key: hmac.new(hasher(salt + force_bytes(key)).digest(), digestmod=hasher)
+            for key in [self.key, *self.fallback_keys]
+        }
+
+    def signature(self, value, key=None):
+        if (mac := self._hmacs.get(key or self.key)) is None:
+            return super().signature(value, key)
+        mac = mac.copy()
+        mac.update(force_bytes(value))
+        return signing.b64_encode(mac.digest()).decode()
+
+    def _compact_mac(self, header, value):
+        mac = self._hmacs[self.key].copy()
+        mac.update(header + value.encode())
+        return mac.digest()[:_COMPACT_MAC_LENGTH]
+
+    def sign_compact(self, value):
+        """
+        Appends a tag consisting of the format version, a binary timestamp and
+        a truncated HMAC to ``value``
+        """
+        header = _COMPACT_HEADER.pack(1, int(time.time()))
+        tag = signing.b64_encode(header + self._compact_mac(header, value))
+        return f"{value}.{tag.decode()}"
+
+    def unsign_compact(self, signed_value, max_age=None):
+        value, _sep, tag = signed_value.rpartition(".")
+        try:
+            raw = signing.b64_decode(tag.encode())
+        except (binascii.Error, UnicodeEncodeError) as exc:
+            raise signing.BadSignature("Invalid tag") from exc
+        header = raw[: _COMPACT_HEADER.size]
+        if len(raw) != _COMPACT_HEADER.size + _COMPACT_MAC_LENGTH or raw[0] != 1:
+            raise signing.BadSignature("Unknown code format")
+        if not hmac.compare_digest(
+            raw[_COMPACT_HEADER.size :], self._compact_mac(header, value)
+        ):
+            raise signing.BadSignature(f'Signature "{tag}" does not match')
+        _version, timestamp = _COMPACT_HEADER.unpack(header)
+        if max_age is not None and (age := time.time() - timestamp) > max_age:
+            raise signing.SignatureExpired(f"Signature age {age} > {max_age} seconds")
+        return value
+
+
+@cache
+def _signers(salt):
+    keys = [settings.SECRET_KEY, *settings.SECRET_KEY_FALLBACKS]
+    return (
+        _Signer(salt=salt, key=keys[0], fallback_keys=keys[1:]),
+        [_Signer(salt=salt, key=key, fallback_keys=[]) for key in keys],
+    )
+
+
 def get_signer(salt="email_registration"):
     """
     Returns the signer instance used to sign and unsign the registration
     link tokens
+
+    Signers are cached per salt and rebuilt when ``SECRET_KEY`` or
+    ``SECRET_KEY_FALLBACKS`` change.
     """
-    return signing.TimestampSigner(salt=salt)
+    return _signers(salt)[0]
+
+
+def _unsign(code, *, max_age, compact=False, salt="email_registration"):
+    """
+    Verifies the code using ``SECRET_KEY`` first and each entry of
+    ``SECRET_KEY_FALLBACKS`` afterwards
+
+    Codes verified by one of the fallback keys are logged to help with
+    deciding when old keys can be removed during a key rotation.
+    """
+    for index, signer in enumerate(_signers(salt)[1]):
+        unsign = signer.unsign_compact if compact else signer.unsign
+        try:
+            data = unsign(code, max_age=max_age)
+        except signing.SignatureExpired:
+            raise
+        except signing.BadSignature:
+            continue
+        if index:
+            logger.info(
+                "Confirmation code verified using SECRET_KEY_FALLBACKS[%s]",
+                index - 1,
+                extra={"key_index": index},
+            )
+        return data
+    raise signing.BadSignature("Signature does not match")
 
 
 def get_confirmation_code(email, *, payload=""):
@@ -79,9 +220,30 @@ def get_confirmation_code(email, *, payload=""):
     Returns the code for the confirmation URL
 
     The payload should be a string already.
+
+    If ``AUTHLIB_COMPACT_CODES`` is set the code uses a shorter signature and
+    a binary timestamp. Additionally, long payloads are stored in the cache
+    named by ``AUTHLIB_CODE_PAYLOAD_CACHE`` (if set) for
+    ``AUTHLIB_CODE_PAYLOAD_TIMEOUT`` seconds (default one week) and only
+    their key is added to the code.
     """
-    s = f"{email}:{payload}"
-    return get_signer().sign(signing.b64_encode(s.encode("utf-8")).decode("utf-8"))
+    if not getattr(settings, "AUTHLIB_COMPACT_CODES", False):
+        s = f"{email}:{payload}"
+        return get_signer().sign(signing.b64_encode(s.encode("utf-8")).decode("utf-8"))
+
+    key = None
+    if len(payload) > _PAYLOAD_MAX_LENGTH and (
+        alias := getattr(settings, "AUTHLIB_CODE_PAYLOAD_CACHE", None)
+    ):
+        key = secrets.token_urlsafe(12)
+        caches[alias].set(
+            f"authlib-code-{key}",
+            payload,
+            timeout=getattr(settings, "AUTHLIB_CODE_PAYLOAD_TIMEOUT", 7 * 86400),
+        )
+        payload = ""
+    value = signing.b64_encode(f"{email}:{payload}".encode()).decode()
+    return get_signer().sign_compact(f"{value}.{key}" if key else value)
 
 
 def get_confirmation_url(email, request, name="email_registration_confirm", **kwargs):
@@ -112,13 +274,119 @@ def send_registration_mail(email, *, request, **kwargs):
     * ``registration/email_registration_email.html``: The body of the HTML
       version of the mail. This template is **NOT** available by default and
       is not required either.
+
+    If ``AUTHLIB_MAIL_OUTBOX`` is set the mail is only added to the outbox of
+    ``authlib.outbox`` and sent later by the ``send_outbox`` management
+    command. If ``AUTHLIB_MAIL_DEFER`` is set the mail is sent after the
+    response has been returned to the client instead.
+    """
+    message = _registration_mail(email, request=request, **kwargs)
+    if getattr(settings, "AUTHLIB_MAIL_OUTBOX", False):
+        from authlib.outbox.models import Message
+
+        Message.objects.enqueue(message)
+    elif getattr(settings, "AUTHLIB_MAIL_DEFER", False):
+        defer_mail(message)
+    else:
+        message.send()
+
+
+def defer_mail(message):
     """
+    Sends the message when the current request has finished
+
+    Deferred messages are sent using a single connection from a
+    ``request_finished`` signal handler, that is after the response has been
+    delivered to the client. Errors are logged since they cannot be shown to
+    the user anymore. Outside the request-response cycle the message is sent
+    immediately.
+    """
+    if (messages := getattr(_deferred, "messages", None)) is None:
+        message.send()
+    else:
+        messages.append(message)
+
+
+@receiver(request_started)
+def _start_deferring(**kwargs):
+    _deferred.messages = []
+
 
-    render_to_mail(
+@receiver(request_finished)
+def _send_deferred(**kwargs):
+    messages, _deferred.messages = getattr(_deferred, "messages", None), None
+    if not messages:
+        return
+    try:
+        connection = get_connection()
+        connection.open()
+    except Exception:
+        logger.exception(
+            "Sending deferred mails to %s failed", [message.to for message in messages]
+        )
+        return
+    for message in messages:
+        try:
+            connection.send_messages([message])
+        except Exception:
+            logger.exception("Sending deferred mail to %s failed", message.to)
+    with suppress(Exception):
+        connection.close()
+
+
+def _registration_mail(email, *, request, connection=None, **kwargs):
+    return render_to_mail(
         "registration/email_registration_email",
         {"url": get_confirmation_url(email, request, **kwargs)},
         to=[email],
-    ).send()
+        connection=connection,
+    )
+
+
+def send_registration_mails(emails, *, request, batch_size=100, **kwargs):
+    """send_registration_mails(emails, *, request, batch_size=100, **kwargs)
+    Sends registration mails to many addresses
+
+    * ``emails``: An iterable of email addresses, consumed lazily.
+    * ``request``: See ``send_registration_mail``.
+    * ``batch_size``: The number of mails sent using one connection to the
+      mail server.
+    * Additional keyword arguments are passed on as in
+      ``send_registration_mail``.
+
+    The mails of a batch are rendered first and then sent one after the other
+    using the same connection so that failures can be attributed to their
+    address. If the connection cannot be opened all mails of the batch fail.
+    Returns a dict mapping addresses which failed to the exception.
+    """
+    failures = {}
+    emails = iter(emails)
+    connection = get_connection()
+    while batch := list(islice(emails, batch_size)):
+        messages = []
+        for email in batch:
+            try:
+                messages.append(
+                    _registration_mail(
+                        email, request=request, connection=connection, **kwargs
+                    )
+                )
+            except Exception as exc:
+                failures[email] = exc
+        try:
+            connection.open()
+        except Exception as exc:
+            # Report the whole batch and try again with the next one
+            failures |= {message.to[0]: exc for message in messages}
+            continue
+        for message in messages:
+            try:
+                connection.send_messages([message])
+            except Exception as exc:
+                failures[message.to[0]] = exc
+        with suppress(Exception):
+            connection.close()
+    return failures
 
 
 def decode(code, *, max_age):
@@ -131,14 +399,19 @@ def decode(code, *, max_age):
 
     This method raises ``ValidationError`` exceptions when anything goes wrong
     when verifying the signature or the expiry timeout.
+
+    Both the default and the compact format of ``get_confirmation_code`` are
+    accepted.
     """
+    expired = ValidationError(
+        _("The link is expired. Please request another registration link."),
+        code="email_registration_expired",
+    )
+    compact = ":" not in code
     try:
-        data = get_signer().unsign(code, max_age=max_age)
+        data = _unsign(code, max_age=max_age, compact=compact)
     except signing.SignatureExpired as exc:
-        raise ValidationError(
-            _("The link is expired. Please request another registration link."),
-            code="email_registration_expired",
-        ) from exc
+        raise expired from exc
 
     except signing.BadSignature as exc:
         raise ValidationError(
@@ -149,10 +422,19 @@ def decode(code, *, max_age):
             code="email_registration_signature",
         ) from exc
 
+    key = None
+    if compact:
+        data, _sep, key = data.partition(".")
+
     try:
         data = signing.b64_decode(data.encode("utf-8")).decode("utf-8")
     except (binascii.Error, UnicodeDecodeError):
         if ":" not in data:
             raise
 
-    return data.split(":", 1)
+    email, payload = data.split(":", 1)
+    if key:
+        alias = getattr(settings, "AUTHLIB_CODE_PAYLOAD_CACHE", None) or "default"
+        if (payload := caches[alias].get(f"authlib-code-{key}")) is None:
+            raise expired
+    return [email, payload]
@@ -1,6 +1,8 @@
 from django.conf import settings
 from requests_oauthlib import OAuth2Session
 
+from authlib._http import pooled
+
 
 class FacebookOAuth2Client:
     authorization_base_url = "https://www.facebook.com/dialog/oauth"
@@ -11,10 +13,13 @@ class FacebookOAuth2Client:
 
     def __init__(self, request):
         self._request = request
-        self._session = OAuth2Session(
-            self.client_id,
-            scope=self.scope,
-            redirect_uri=request.build_absolute_uri("."),
+        self._session = pooled(
+            OAuth2Session(
+                self.client_id,
+                scope=self.scope,
+                redirect_uri=request.build_absolute_uri("."),
+            ),
+            provider="facebook",
         )
 
     def get_authentication_url(self):
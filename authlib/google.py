@@ -3,8 +3,23 @@ import json
 import os
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from requests_oauthlib import OAuth2Session
 
+from authlib._http import pooled
+
+
+try:
+    from jwt.algorithms import has_crypto
+except ImportError:  # PyJWT is not installed
+    has_crypto = False
+
+# Google signs ID tokens using RS256 which requires cryptography
+if has_crypto:
+    from authlib import jwks
+else:
+    jwks = None
+
 
 def b64decode(input):
     if isinstance(input, str):
@@ -21,6 +36,8 @@ def b64decode(input):
 class GoogleOAuth2Client:
     authorization_base_url = "https://accounts.google.com/o/oauth2/v2/auth"
     token_url = "https://www.googleapis.com/oauth2/v4/token"
+    jwks_url = "https://www.googleapis.com/oauth2/v3/certs"
+    issuers = ["https://accounts.google.com", "accounts.google.com"]
     scope = ["openid", "email", "profile"]
     client_id = settings.GOOGLE_CLIENT_ID
     client_secret = settings.GOOGLE_CLIENT_SECRET
@@ -30,14 +47,40 @@ class GoogleOAuth2Client:
         os.environ["OAUTHLIB_RELAX_TOKEN_SCOPE"] = "1"
 
         self._request = request
-        self._session = OAuth2Session(
-            self.client_id,
-            scope=self.scope,
-            redirect_uri=request.build_absolute_uri("."),
+        self._session = pooled(
+            OAuth2Session(
+                self.client_id,
+                scope=self.scope,
+                redirect_uri=request.build_absolute_uri("."),
+            ),
+            provider="google",
         )
         self._login_hint = login_hint
         self._authorization_params = authorization_params or {}
 
+    @classmethod
+    def verify_id_token(cls, id_token, *, audience=None):
+        """
+        Verifies an ID token issued by Google and returns its claims
+
+        The signature is checked using Google's cached key set, ``aud`` has to
+        be ``audience`` (default: ``client_id``). Use this for ID tokens
+        received from other sources, e.g. from mobile apps. Requires PyJWT
+        with cryptography support.
+        """
+        if jwks is None:
+            raise ImproperlyConfigured(
+                "Verifying ID tokens requires PyJWT with cryptography support,"
+                " install django-authlib[jwt]."
+            )
+        return jwks.decode(
+            id_token,
+            jwks_url=cls.jwks_url,
+            audience=audience or cls.client_id,
+            issuer=cls.issuers,
+            provider="google",
+        )
+
     def get_authentication_url(self):
         self._authorization_params.setdefault("login_hint", self._login_hint)
         authorization_url, self._state = self._session.authorization_url(
@@ -54,10 +97,15 @@ class GoogleOAuth2Client:
                 self._request.get_full_path()
             ),
         )
-        # NOTE! We received the id_token directly from Google. Skipping
-        # verification is fine in this case but you MUST NOT SAVE AND USE THIS
-        # TOKEN LATER.
-        data = json.loads(b64decode(token["id_token"].split(".")[1]).decode("utf-8"))
+        if jwks:
+            data = self.verify_id_token(token["id_token"])
+        else:
+            # NOTE! We received the id_token directly from Google. Skipping
+            # verification is fine in this case but you MUST NOT SAVE AND USE
+            # THIS TOKEN LATER.
+            data = json.loads(
+                b64decode(token["id_token"].split(".")[1]).decode("utf-8")
+            )
         return (
             {"email": data.get("email"), "full_name": data.get("name")}
             if data.get("email_verified")
@@ -0,0 +1,127 @@
+"""
+Verification of JSON Web Tokens against a provider's JSON Web Key Set
+
+Requires PyJWT with cryptography support, e.g. ``pip install
+django-authlib[jwt]``.
+"""
+
+import hashlib
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+import jwt
+import requests
+from django.conf import settings
+from django.core.cache import caches
+
+from authlib._http import pooled
+
+
+# Unknown key IDs trigger a refresh at most this often (in seconds)
+REFRESH_INTERVAL = 60
+DEFAULT_MAX_AGE = 3600
+
+_key_sets = {}
+_lock = threading.Lock()
+
+
+def _cache():
+    alias = getattr(settings, "AUTHLIB_JWKS_CACHE", "default")
+    return None if alias is None else caches[alias]
+
+
+def _cache_key(url):
+    return f"authlib-jwks-{hashlib.md5(url.encode()).hexdigest()}"
+
+
+def _max_age(response):
+    match = re.search(r"max-age=(\d+)", response.headers.get("Cache-Control", ""))
+    return int(match[1]) if match else DEFAULT_MAX_AGE
+
+
+def _fetch(url, provider):
+    # Closing the session would also close the shared adapter
+    response = pooled(requests.Session(), provider=provider).get(url)
+    response.raise_for_status()
+    return response.json(), time.time() + _max_age(response)
+
+
+def _parse(data):
+    return {
+        key.key_id: key
+        for key in jwt.PyJWKSet.from_dict(data).keys
+        if key.public_key_use in {None, "sig"}
+    }
+
+
+def _key_set(url, *, provider, refresh=False):
+    """
+    Returns a ``(keys, expires, fetched)`` tuple for the key set at ``url``
+
+    Key sets are cached in process and in the cache named by
+    ``AUTHLIB_JWKS_CACHE`` (default: ``"default"``) for as long as the
+    ``Cache-Control`` header of the response allows.
+    """
+    started = time.time()
+    cache = _cache()
+    if not refresh:
+        if (entry := _key_sets.get(url)) and entry[1] > started:
+            return entry
+        if cache is not None and (cached := cache.get(_cache_key(url))):
+            data, expires, fetched = cached
+            if expires > started:
+                entry = _key_sets[url] = (_parse(data), expires, fetched)
+                return entry
+
+    with _lock:
+        # Another thread may have fetched the key set while we were waiting
+        if (entry := _key_sets.get(url)) and entry[2] > started:
+            return entry
+        data, expires = _fetch(url, provider)
+        fetched = time.time()
+        entry = _key_sets[url] = (_parse(data), expires, fetched)
+    if cache is not None:
+        cache.set(_cache_key(url), (data, expires, fetched), int(expires - fetched) + 1)
+    return entry
+
+
+def signing_key(url, kid, *, provider=None):
+    """
+    Returns the key with the ID ``kid`` from the key set at ``url``
+
+    The key set is only fetched again when it has expired or when it does not
+    contain ``kid``, but at most every ``REFRESH_INTERVAL`` seconds in the
+    latter case. Requests use the timeouts and the circuit breaker of
+    ``provider`` (default: the host of ``url``).
+    """
+    provider = provider or urlsplit(url).netloc
+    keys, _expires, fetched = _key_set(url, provider=provider)
+    if kid not in keys and fetched < time.time() - REFRESH_INTERVAL:
+        keys = _key_set(url, provider=provider, refresh=True)[0]
+    try:
+        return keys[kid]
+    except KeyError as exc:
+        raise jwt.InvalidTokenError(f"Unknown key ID {kid!r}") from exc
+
+
+def decode(token, *, jwks_url, audience, issuer, leeway=0, provider=None):
+    """
+    Verifies the signature, audience, issuer and expiry of ``token`` and
+    returns the claims
+
+    ``issuer`` may also be a list of accepted issuers. Raises a subclass of
+    ``jwt.InvalidTokenError`` if the token isn't valid.
+    """
+    header = jwt.get_unverified_header(token)
+    key = signing_key(jwks_url, header.get("kid"), provider=provider)
+    return jwt.decode(
+        token,
+        key=key,
+        algorithms=[key.algorithm_name],
+        audience=audience,
+        issuer=issuer,
+        leeway=leeway,
+        options={"require": ["aud", "exp", "iss"]},
+    )
@@ -1,8 +1,9 @@
+from django.conf import settings
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as StockUserAdmin
 from django.utils.translation import gettext_lazy as _
 
-from authlib.little_auth.models import User
+from authlib.little_auth.models import Role, User
 
 
 @admin.register(User)
@@ -59,3 +60,14 @@ class UserAdmin(StockUserAdmin):
     filter_horizontal = ("groups", "user_permissions")
     radio_fields = {"role": admin.VERTICAL}
     readonly_fields = ["last_login"]
+
+
+class RoleAdmin(admin.ModelAdmin):
+    list_display = ("title", "key")
+    prepopulated_fields = {"key": ("title",)}
+    search_fields = ("title", "key")
+
+
+# Database roles are ignored unless AUTHLIB_DATABASE_ROLES is set
+if getattr(settings, "AUTHLIB_DATABASE_ROLES", False):
+    admin.site.register(Role, RoleAdmin)
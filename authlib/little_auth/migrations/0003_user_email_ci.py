@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:55
+
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("little_auth", "0002_user_role"),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name="user",
+            constraint=models.UniqueConstraint(
+                django.db.models.functions.text.Lower("email"),
+                name="little_auth_user_email_ci",
+            ),
+        ),
+    ]
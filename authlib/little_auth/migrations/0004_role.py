@@ -0,0 +1,60 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("little_auth", "0003_user_email_ci"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Role",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "key",
+                    models.SlugField(max_length=100, unique=True, verbose_name="key"),
+                ),
+                ("title", models.CharField(max_length=200, verbose_name="title")),
+                (
+                    "allow",
+                    models.TextField(
+                        blank=True,
+                        help_text="Permission globs, one per line, e.g. app_label.* or *.view_*",
+                        verbose_name="allow",
+                    ),
+                ),
+                (
+                    "deny",
+                    models.TextField(
+                        blank=True,
+                        help_text="Permission globs, one per line. Deny rules always win.",
+                        verbose_name="deny",
+                    ),
+                ),
+                (
+                    "extends",
+                    models.TextField(
+                        blank=True,
+                        help_text="Keys of roles whose rules should be inherited, one per line.",
+                        verbose_name="extends",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "role",
+                "verbose_name_plural": "roles",
+                "ordering": ["title"],
+            },
+        ),
+    ]
@@ -1,8 +1,11 @@
-from django.db import models
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils.translation import gettext_lazy as _
 
 from authlib.base_user import BaseUser
-from authlib.roles import RoleField
+from authlib.roles import RoleField, _check_database_role, invalidate_roles
 
 
 def _obfuscate(email):
@@ -34,3 +37,61 @@ class User(BaseUser):
 
     def get_short_name(self):
         return self.__str__()
+
+
+def _lines(value):
+    return [line.strip() for line in value.splitlines() if line.strip()]
+
+
+class Role(models.Model):
+    key = models.SlugField(_("key"), max_length=100, unique=True)
+    title = models.CharField(_("title"), max_length=200)
+    allow = models.TextField(
+        _("allow"),
+        blank=True,
+        help_text=_("Permission globs, one per line, e.g. app_label.* or *.view_*"),
+    )
+    deny = models.TextField(
+        _("deny"),
+        blank=True,
+        help_text=_("Permission globs, one per line. Deny rules always win."),
+    )
+    extends = models.TextField(
+        _("extends"),
+        blank=True,
+        help_text=_("Keys of roles whose rules should be inherited, one per line."),
+    )
+
+    class Meta:
+        ordering = ["title"]
+        verbose_name = _("role")
+        verbose_name_plural = _("roles")
+
+    def __str__(self):
+        return self.title
+
+    def clean(self):
+        super().clean()
+        database = {role.key: role.config() for role in Role.objects.all()}
+        previous = Role.objects.filter(pk=self.pk).values_list("key", flat=True).first()
+        try:
+            _check_database_role(
+                self.key, self.config(), database=database, previous=previous
+            )
+        except ImproperlyConfigured as exc:
+            raise ValidationError(str(exc)) from exc
+
+    def config(self):
+        return {
+            "title": self.title,
+            "allow": _lines(self.allow),
+            "deny": _lines(self.deny),
+            "extends": _lines(self.extends),
+        }
+
+
+@receiver(post_save, sender=Role)
+@receiver(post_delete, sender=Role)
+def _invalidate_roles(*, using, **kwargs):
+    # Other processes must not load and cache the old rows under the new version
+    transaction.on_commit(invalidate_roles, using=using)
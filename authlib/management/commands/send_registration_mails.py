@@ -0,0 +1,61 @@
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+from django.http import HttpRequest
+
+from authlib.email import send_registration_mails
+
+
+class _Request(HttpRequest):
+    """
+    Request used for building absolute registration links
+    """
+
+    def __init__(self, base_url):
+        super().__init__()
+        parts = urlsplit(base_url)
+        if parts.scheme not in {"http", "https"} or not parts.netloc:
+            raise CommandError(f"Invalid base URL {base_url!r}")
+        self._scheme = parts.scheme
+        self.META["HTTP_HOST"] = parts.netloc
+        self.path = self.path_info = "/"
+
+    def _get_scheme(self):
+        return self._scheme
+
+
+class Command(BaseCommand):
+    help = "Sends registration mails to all addresses in a file (one per line)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("file", help="The file containing email addresses.")
+        parser.add_argument(
+            "--base-url",
+            required=True,
+            help="The URL of the site used for building links, e.g. https://example.com",
+        )
+        parser.add_argument("--batch-size", type=int, default=100)
+
+    def handle(self, *, file, base_url, batch_size, **options):
+        request = _Request(base_url)
+        total = 0
+
+        def emails(f):
+            nonlocal total
+            for line in f:
+                if email := line.strip():
+                    total += 1
+                    yield email
+
+        with open(file, encoding="utf-8") as f:
+            failures = send_registration_mails(
+                emails(f), request=request, batch_size=batch_size
+            )
+
+        for email, exc in failures.items():
+            self.stderr.write(f"{email}: {exc}")
+        self.stdout.write(
+            f"Sent {total - len(failures)} of {total} registration mails."
+        )
+        if failures:
+            raise CommandError(f"Sending {len(failures)} mails failed.")
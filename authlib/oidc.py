@@ -0,0 +1,137 @@
+"""
+Generic OpenID Connect client
+
+Requires PyJWT with cryptography support, e.g. ``pip install
+django-authlib[jwt]``.
+"""
+
+import hashlib
+import os
+import threading
+import time
+
+import requests
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from requests_oauthlib import OAuth2Session
+
+from authlib import jwks
+from authlib._http import pooled
+
+
+_discovery = {}
+_lock = threading.Lock()
+
+
+def _cache():
+    alias = getattr(settings, "AUTHLIB_OIDC_CACHE", "default")
+    return None if alias is None else caches[alias]
+
+
+def discover(issuer):
+    """
+    Returns the provider metadata of ``issuer``
+
+    The metadata is fetched from ``.well-known/openid-configuration`` and
+    cached in process and in the cache named by ``AUTHLIB_OIDC_CACHE``
+    (default: ``"default"``) for ``AUTHLIB_OIDC_DISCOVERY_TIMEOUT`` seconds
+    (default: one day). Raises ``ImproperlyConfigured`` if the ``issuer`` of
+    the metadata differs from ``issuer``.
+    """
+    if (entry := _discovery.get(issuer)) and entry[1] > time.time():
+        return entry[0]
+
+    cache = _cache()
+    key = f"authlib-oidc-{hashlib.md5(issuer.encode()).hexdigest()}"
+    if cache is not None and (entry := cache.get(key)) and entry[1] > time.time():
+        _discovery[issuer] = entry
+        return entry[0]
+
+    with _lock:
+        if (entry := _discovery.get(issuer)) and entry[1] > time.time():
+            return entry[0]
+        url = f"{issuer.rstrip('/')}/.well-known/openid-configuration"
+        # Closing the session would also close the shared adapter
+        response = pooled(requests.Session(), provider=issuer).get(url)
+        response.raise_for_status()
+        metadata = response.json()
+        # OpenID Connect Discovery 1.0, section 4.3
+        if metadata.get("issuer") != issuer:
+            raise ImproperlyConfigured(
+                f"The issuer {metadata.get('issuer')!r} of the provider metadata"
+                f" does not match {issuer!r}."
+            )
+        timeout = getattr(settings, "AUTHLIB_OIDC_DISCOVERY_TIMEOUT", 86400)
+        entry = _discovery[issuer] = (metadata, time.time() + timeout)
+    if cache is not None:
+        cache.set(key, entry, timeout)
+    return entry[0]
+
+
+class OIDCClient:
+    """
+    OpenID Connect client for ``authlib.views.oauth2``
+
+    Subclass and set ``issuer``, ``client_id`` and ``client_secret``, the
+    endpoints are determined using OpenID Connect discovery.
+    """
+
+    issuer = None
+    client_id = None
+    client_secret = None
+    scope = ["openid", "email", "profile"]
+    # Ignore addresses not verified by the provider
+    require_email_verified = True
+
+    def __init__(self, request, *, authorization_params=None):
+        # let oauthlib be less strict on scope mismatch
+        os.environ["OAUTHLIB_RELAX_TOKEN_SCOPE"] = "1"
+
+        self._request = request
+        self._session = pooled(
+            OAuth2Session(
+                self.client_id,
+                scope=self.scope,
+                redirect_uri=request.build_absolute_uri("."),
+            ),
+            provider=self.issuer,
+        )
+        self._authorization_params = authorization_params or {}
+
+    @classmethod
+    def metadata(cls):
+        return discover(cls.issuer)
+
+    @classmethod
+    def verify_id_token(cls, id_token, *, audience=None):
+        """
+        Verifies an ID token issued by the provider and returns its claims
+        """
+        metadata = cls.metadata()
+        return jwks.decode(
+            id_token,
+            jwks_url=metadata["jwks_uri"],
+            audience=audience or cls.client_id,
+            issuer=metadata["issuer"],
+            provider=cls.issuer,
+        )
+
+    def get_authentication_url(self):
+        authorization_url, self._state = self._session.authorization_url(
+            self.metadata()["authorization_endpoint"], **self._authorization_params
+        )
+        return authorization_url
+
+    def get_user_data(self):
+        token = self._session.fetch_token(
+            self.metadata()["token_endpoint"],
+            client_secret=self.client_secret,
+            authorization_response=self._request.build_absolute_uri(
+                self._request.get_full_path()
+            ),
+        )
+        data = self.verify_id_token(token["id_token"])
+        if self.require_email_verified and not data.get("email_verified"):
+            return {}
+        return {"email": data.get("email"), "full_name": data.get("name")}
@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+from django.utils.text import capfirst
+from django.utils.translation import gettext_lazy as _
+
+
+class OutboxConfig(AppConfig):
+    name = "authlib.outbox"
+    default_auto_field = "django.db.models.AutoField"
+    verbose_name = capfirst(_("mail outbox"))
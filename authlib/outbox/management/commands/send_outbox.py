@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from authlib.outbox.models import send_queued
+
+
+class Command(BaseCommand):
+    help = "Sends queued mails from the outbox."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument("--max-attempts", type=int, default=5)
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep running and poll for new messages.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=5,
+            help="Seconds to wait when the outbox is empty (with --loop).",
+        )
+
+    def handle(self, *, batch_size, max_attempts, loop, interval, **options):
+        while True:
+            sent, failed = send_queued(batch_size=batch_size, max_attempts=max_attempts)
+            if sent or failed:
+                self.stdout.write(f"Sent {sent} mails, {failed} failed.")
+            if sent + failed < batch_size:
+                if not loop:
+                    break
+                time.sleep(interval)
@@ -0,0 +1,141 @@
+from contextlib import suppress
+from datetime import timedelta
+
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import models, transaction
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+
+
+class MessageQuerySet(models.QuerySet):
+    def enqueue(self, message):
+        """
+        Store an ``EmailMessage`` instance for sending it later
+
+        Call this inside the transaction which should only send the message
+        when it is committed.
+        """
+        return self.create(
+            subject=message.subject,
+            body=message.body,
+            html=next(
+                (
+                    content
+                    for content, mimetype in getattr(message, "alternatives", ())
+                    if mimetype == "text/html"
+                ),
+                "",
+            ),
+            from_email=message.from_email or "",
+            to=list(message.to),
+        )
+
+    def due(self, *, max_attempts):
+        return self.filter(
+            sent_at__isnull=True,
+            next_attempt_at__lte=timezone.now(),
+            attempts__lt=max_attempts,
+        )
+
+
+class Message(models.Model):
+    created_at = models.DateTimeField(_("created at"), default=timezone.now)
+    subject = models.CharField(_("subject"), max_length=1000)
+    body = models.TextField(_("body"))
+    html = models.TextField(_("HTML body"), blank=True)
+    from_email = models.CharField(_("from"), max_length=1000, blank=True)
+    to = models.JSONField(_("to"))
+    attempts = models.PositiveIntegerField(_("attempts"), default=0)
+    next_attempt_at = models.DateTimeField(_("next attempt at"), default=timezone.now)
+    sent_at = models.DateTimeField(_("sent at"), blank=True, null=True)
+    last_error = models.TextField(_("last error"), blank=True)
+
+    objects = MessageQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["next_attempt_at"],
+                condition=models.Q(sent_at__isnull=True),
+                name="outbox_message_due",
+            ),
+        ]
+        ordering = ["next_attempt_at"]
+        verbose_name = _("message")
+        verbose_name_plural = _("messages")
+
+    def __str__(self):
+        return self.subject
+
+    def as_email_message(self, *, connection=None):
+        message = EmailMultiAlternatives(
+            subject=self.subject,
+            body=self.body,
+            from_email=self.from_email or None,
+            to=self.to,
+            connection=connection,
+        )
+        if self.html:
+            message.attach_alternative(self.html, "text/html")
+        return message
+
+
+def _backoff(attempts):
+    return timedelta(seconds=min(60 * 2 ** (attempts - 1), 86400))
+
+
+def _failed(message, exc, now):
+    message.attempts += 1
+    message.next_attempt_at = now + _backoff(message.attempts)
+    message.last_error = f"{exc.__class__.__name__}: {exc}"
+
+
+def send_queued(*, batch_size=100, max_attempts=5):
+    """
+    Send a batch of due messages using a single connection
+
+    Rows are claimed using ``SELECT ... FOR UPDATE SKIP LOCKED`` so that
+    several workers can run concurrently. Failed messages are retried with
+    exponential backoff until ``max_attempts`` is reached, also when the
+    connection cannot be opened. Returns a tuple of the number of sent and
+    failed messages.
+    """
+    sent = failed = 0
+    with transaction.atomic():
+        messages = list(
+            Message.objects.due(max_attempts=max_attempts).select_for_update(
+                skip_locked=True
+            )[:batch_size]
+        )
+        if not messages:
+            return sent, failed
+
+        connection = get_connection()
+        try:
+            connection.open()
+        except Exception as exc:
+            # The relay is unavailable, retry all claimed messages later
+            now = timezone.now()
+            for message in messages:
+                _failed(message, exc, now)
+            failed = len(messages)
+        else:
+            for message in messages:
+                now = timezone.now()
+                try:
+                    connection.send_messages([message.as_email_message()])
+                except Exception as exc:
+                    _failed(message, exc, now)
+                    failed += 1
+                else:
+                    message.attempts += 1
+                    message.sent_at = now
+                    sent += 1
+            # Do not roll back the state of messages which have been sent
+            with suppress(Exception):
+                connection.close()
+
+        Message.objects.bulk_update(
+            messages, ["attempts", "next_attempt_at", "sent_at", "last_error"]
+        )
+    return sent, failed
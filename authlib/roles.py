@@ -1,11 +1,24 @@
-from fnmatch import fnmatch
+import logging
+import re
+import time
+from fnmatch import fnmatch, translate
+from functools import cache, partial
+from types import MappingProxyType
 
 from django import forms
 from django.conf import settings
-from django.core.exceptions import PermissionDenied
-from django.db import models
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured, PermissionDenied
+from django.core.signals import setting_changed
+from django.db import DatabaseError, models, router, transaction
+from django.dispatch import receiver
 from django.utils.translation import gettext_lazy as _
 
+from authlib._compat import BaseChoiceIterator
+
+
+logger = logging.getLogger(__name__)
+
 
 def allow_deny_globs(user, perm, obj, allow=(), deny=()):
     if any(fnmatch(perm, rule) for rule in deny):
@@ -13,6 +26,69 @@ def allow_deny_globs(user, perm, obj, allow=(), deny=()):
     return any(fnmatch(perm, rule) for rule in allow)
 
 
+class _Globs:
+    """
+    A set of glob rules compiled for fast matching
+
+    Rules without wildcards and rules of the form ``app_label.*`` are
+    handled using set lookups, all other rules are combined into a single
+    regular expression.
+    """
+
+    def __init__(self, rules):
+        self.rules = frozenset(rules)
+        self.exact = {rule for rule in self.rules if not _has_wildcard(rule)}
+        self.apps = {
+            rule[:-2]
+            for rule in self.rules
+            # Codenames may contain dots, e.g. "shop.export.*"
+            if rule.endswith(".*")
+            and not _has_wildcard(rule[:-2])
+            and "." not in rule[:-2]
+        }
+        rest = self.rules - self.exact - {f"{app}.*" for app in self.apps}
+        self.regex = (
+            re.compile("|".join(translate(rule) for rule in sorted(rest))).match
+            if rest
+            else None
+        )
+
+    def match(self, perm):
+        app_label, sep, _codename = perm.partition(".")
+        return (
+            perm in self.exact
+            or bool(sep and app_label in self.apps)
+            or bool(self.regex and self.regex(perm))
+        )
+
+
+def _has_wildcard(rule):
+    return any(char in rule for char in "*?[")
+
+
+class _AllowDenyGlobs:
+    def __init__(self, allow, deny):
+        self.allow = _Globs(allow)
+        self.deny = _Globs(deny)
+
+    def __call__(self, user, perm, obj):
+        if self.deny.match(perm):
+            raise PermissionDenied
+        return self.allow.match(perm)
+
+    def __repr__(self):
+        return f"compile_allow_deny_globs(allow={sorted(self.allow.rules)!r}, deny={sorted(self.deny.rules)!r})"
+
+
+def compile_allow_deny_globs(*, allow=(), deny=()):
+    """
+    Return a role callback equivalent to ``partial(allow_deny_globs, allow=...,
+    deny=...)`` which compiles the rules once instead of matching each rule
+    separately for every permission
+    """
+    return _AllowDenyGlobs(allow, deny)
+
+
 DEFAULT_ROLES = {
     "default": {
         "title": _("default"),
@@ -20,16 +96,260 @@ DEFAULT_ROLES = {
 }
 
 
+def _compile_callback(callback):
+    # Swap partial(allow_deny_globs, allow=..., deny=...) for its compiled
+    # equivalent
+    if (
+        isinstance(callback, partial)
+        and callback.func is allow_deny_globs
+        and not callback.args
+        and set(callback.keywords) <= {"allow", "deny"}
+    ):
+        return compile_allow_deny_globs(**callback.keywords)
+    return callback
+
+
+def _role_rules(config):
+    """
+    Return a ``{key: (allow, deny)}`` dict with the flattened rules of all
+    roles defined using ``allow`` and ``deny`` globs, including the rules of
+    the roles they extend
+    """
+    resolved = {}
+
+    def resolve(key, path):
+        if key in path:
+            raise ImproperlyConfigured(
+                f"Circular role inheritance: {' -> '.join([*path, key])}"
+            )
+        if key not in config:
+            raise ImproperlyConfigured(
+                f"The role {path[-1]!r} extends the unknown role {key!r}."
+            )
+        if key not in resolved:
+            cfg = config[key]
+            callback = _compile_callback(cfg.get("callback"))
+            if isinstance(callback, _AllowDenyGlobs):
+                allow, deny = set(callback.allow.rules), set(callback.deny.rules)
+            elif callback is None:
+                allow, deny = set(cfg.get("allow", ())), set(cfg.get("deny", ()))
+            else:
+                raise ImproperlyConfigured(
+                    f"The role {key!r} uses a custom callback and cannot be"
+                    " used with role inheritance."
+                )
+            for parent in cfg.get("extends", ()):
+                parent_allow, parent_deny = resolve(parent, [*path, key])
+                allow |= parent_allow
+                deny |= parent_deny
+            resolved[key] = (frozenset(allow), frozenset(deny))
+        return resolved[key]
+
+    for key, cfg in config.items():
+        if "callback" in cfg and ({"allow", "deny"} & set(cfg)):
+            raise ImproperlyConfigured(
+                f"The role {key!r} cannot define a callback and allow or deny rules."
+            )
+        if cfg.get("extends") or "callback" not in cfg:
+            resolve(key, [])
+    return resolved
+
+
+def _build_roles(config):
+    roles = {}
+    for key, cfg in config.items():
+        if "title" not in cfg:
+            raise ImproperlyConfigured(f"The role {key!r} has no title.")
+        if (callback := cfg.get("callback")) is not None and not callable(callback):
+            raise ImproperlyConfigured(f"The callback of role {key!r} is not callable.")
+    rules = _role_rules(config)
+    for key, cfg in config.items():
+        if key in rules:
+            allow, deny = rules[key]
+            callback = (
+                compile_allow_deny_globs(allow=allow, deny=deny)
+                if allow or deny
+                else None
+            )
+            cfg = cfg | {"allow": allow, "deny": deny}  # noqa: PLW2901
+        else:
+            callback = _compile_callback(cfg.get("callback"))
+        roles[key] = MappingProxyType(cfg | {"callback": callback})
+    if not roles:
+        raise ImproperlyConfigured("AUTHLIB_ROLES has to contain at least one role.")
+    return MappingProxyType(roles)
+
+
+def _add_database_roles(config, database):
+    """
+    Return ``config`` with all valid roles from ``database`` added and a
+    ``{key: error}`` dict of the rows which have been skipped
+
+    Roles defined in the settings take precedence. Rows are added as long as
+    the registry stays valid, rows extending other rows are retried once
+    their parents have been added.
+    """
+    config = dict(config)
+    pending = {key: cfg for key, cfg in database.items() if key not in config}
+    errors = {}
+    while pending:
+        errors = {}
+        for key, cfg in pending.items():
+            try:
+                _build_roles(config | {key: cfg})
+            except ImproperlyConfigured as exc:
+                errors[key] = str(exc)
+            else:
+                config[key] = cfg
+        if len(errors) == len(pending):
+            break
+        pending = {key: database[key] for key in errors}
+    return config, errors
+
+
+def _check_database_role(key, cfg, *, database, previous=None):
+    """
+    Raise ``ImproperlyConfigured`` if adding the role ``key`` (replacing the
+    row ``previous``) to the roles from the settings and the ``database``
+    would result in an invalid registry
+    """
+    roles = getattr(settings, "AUTHLIB_ROLES", DEFAULT_ROLES)
+    if key in roles:
+        raise ImproperlyConfigured(f"The role {key!r} is defined in the settings.")
+    config, _errors = _add_database_roles(roles, database)
+    if previous not in roles:
+        # The row may have been renamed
+        config.pop(previous, None)
+    _build_roles(config | {key: cfg})
+
+
+ROLES_VERSION_KEY = "authlib-roles-version"
+_registry = {"roles": None, "version": 0, "shared": None, "checked": None}
+
+
+@cache
+def _settings_roles():
+    _registry["version"] += 1
+    return _build_roles(getattr(settings, "AUTHLIB_ROLES", DEFAULT_ROLES))
+
+
+@cache
+def _database_roles_enabled():
+    return getattr(settings, "AUTHLIB_DATABASE_ROLES", False)
+
+
+def _roles_cache():
+    return caches[getattr(settings, "AUTHLIB_ROLES_CACHE", "default")]
+
+
+def _database_roles(shared_version):
+    """
+    Return the configuration of roles stored in the database
+
+    The configuration is cached in the Django cache under a key containing the
+    shared version. Returns ``None`` if the role table cannot be queried,
+    e.g. because migrations have not been applied yet.
+    """
+    from authlib.little_auth.models import Role
+
+    key = f"authlib-roles-{shared_version}"
+    if (config := _roles_cache().get(key)) is None:
+        try:
+            with transaction.atomic(using=router.db_for_read(Role)):
+                config = {role.key: role.config() for role in Role.objects.all()}
+        except DatabaseError:
+            return None
+        _roles_cache().set(key, config)
+    return config
+
+
 def _roles():
-    return getattr(settings, "AUTHLIB_ROLES", DEFAULT_ROLES)
+    """
+    Return the validated and immutable registry of roles
+
+    The registry is built once per process from the ``AUTHLIB_ROLES`` setting
+    and rebuilt when the setting changes. Role inheritance is resolved when
+    building the registry, the callback of each role uses a flat list of
+    compiled rules.
+
+    If ``AUTHLIB_DATABASE_ROLES`` is set, roles stored in the database are
+    added to the registry. The shared version is checked at most every
+    ``AUTHLIB_ROLES_CACHE_INTERVAL`` seconds (default: 10), the database is
+    only queried when the version changed and the roles aren't available in
+    the cache yet. Invalid database roles are logged and skipped.
+    """
+    if not _database_roles_enabled():
+        return _settings_roles()
+
+    now = time.monotonic()
+    interval = getattr(settings, "AUTHLIB_ROLES_CACHE_INTERVAL", 10)
+    if _registry["checked"] is None or now - _registry["checked"] >= interval:
+        _roles_cache().add(ROLES_VERSION_KEY, time.time_ns(), timeout=None)
+        if (shared := _roles_cache().get(ROLES_VERSION_KEY)) != _registry["shared"]:
+            _registry["roles"] = None
+        _registry.update(shared=shared, checked=now)
+
+    if (roles := _registry["roles"]) is None:
+        config = getattr(settings, "AUTHLIB_ROLES", DEFAULT_ROLES)
+        if (database := _database_roles(_registry["shared"])) is None:
+            # Try again next time
+            _registry["checked"] = None
+            return _settings_roles()
+        config, errors = _add_database_roles(config, database)
+        for key, error in errors.items():
+            logger.warning("Skipping invalid database role %r: %s", key, error)
+        roles = _build_roles(config)
+        _registry.update(roles=roles, version=_registry["version"] + 1)
+    return roles
+
+
+def _roles_version():
+    """
+    Return a value which changes each time the role registry is rebuilt
+    """
+    _roles()
+    return _registry["version"]
+
+
+def invalidate_roles():
+    """
+    Reload roles stored in the database in this and all other processes
+    """
+    if _database_roles_enabled():
+        _roles_cache().set(ROLES_VERSION_KEY, time.time_ns(), timeout=None)
+    _registry.update(roles=None, shared=None, checked=None)
+
+
+@receiver(setting_changed)
+def _reset_roles(*, setting, **kwargs):
+    if setting in {
+        "AUTHLIB_ROLES",
+        "AUTHLIB_DATABASE_ROLES",
+        "AUTHLIB_ROLES_CACHE",
+    }:
+        _settings_roles.cache_clear()
+        _database_roles_enabled.cache_clear()
+        _registry.update(roles=None, shared=None, checked=None)
+
+
+def _role_callback(role):
+    return (r := _roles().get(role)) and r["callback"]
+
+
+class _RoleChoices(BaseChoiceIterator):
+    """
+    Lazily evaluated choices which also contain the roles from the database
+    """
+
+    def __iter__(self):
+        return iter([(key, cfg["title"]) for key, cfg in _roles().items()])
 
 
 class RoleField(models.CharField):
     def __init__(self, *args, **kwargs):
-        choices = [(key, cfg["title"]) for key, cfg in _roles().items()]
         kwargs = kwargs | {
-            "choices": choices,
-            "default": choices[0][0],
+            "choices": _RoleChoices(),
+            "default": next(iter(_settings_roles())),
             "max_length": 100,
             "verbose_name": _("role"),
         }
@@ -39,10 +359,12 @@ class RoleField(models.CharField):
         super().contribute_to_class(cls, name)
 
         def _role_has_perm(self, *, perm, obj):
-            if (r := _roles().get(getattr(self, name))) and (cb := r.get("callback")):
+            if cb := _role_callback(getattr(self, name)):
                 return self.is_active and cb(user=self, perm=perm, obj=obj)
 
         cls._role_has_perm = _role_has_perm
+        cls._role = property(lambda self: getattr(self, name))
+        cls._role_field = name
 
     def deconstruct(self):
         name, path, args, kwargs = super().deconstruct()
@@ -50,7 +372,7 @@ class RoleField(models.CharField):
         return name, "django.db.models.CharField", args, kwargs
 
     def formfield(self, **kwargs):
-        if len(self.choices) <= 1:
-            kwargs.setdefault("initial", self.choices[0][0])
+        if len(choices := list(self.choices)) <= 1:
+            kwargs.setdefault("initial", choices[0][0])
             kwargs.setdefault("widget", forms.HiddenInput)
         return super().formfield(**kwargs)
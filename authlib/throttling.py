@@ -0,0 +1,154 @@
+import hashlib
+import ipaddress
+import threading
+import time
+from collections import OrderedDict
+from contextlib import suppress
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+# Maximum number of counters kept in process when the cache is unavailable
+MEMORY_SIZE = 10000
+
+_memory = OrderedDict()
+_memory_lock = threading.Lock()
+
+
+def _memory_store(key, entry):
+    # Must be called with _memory_lock held; evicts the least recently
+    # written counters
+    _memory[key] = entry
+    _memory.move_to_end(key)
+    while len(_memory) > MEMORY_SIZE:
+        _memory.popitem(last=False)
+
+
+def _memory_incr(key, timeout):
+    now = time.monotonic()
+    with _memory_lock:
+        expires, value = _memory.get(key, (0, 0))
+        if expires < now:
+            expires, value = now + timeout, 0
+        _memory_store(key, (expires, value + 1))
+        return value + 1
+
+
+def _memory_get(key):
+    expires, value = _memory.get(key, (0, 0))
+    return value if expires >= time.monotonic() else 0
+
+
+def _cache():
+    alias = getattr(settings, "AUTHLIB_THROTTLE_CACHE", "default")
+    return None if alias is None else caches[alias]
+
+
+def _incr(key, timeout):
+    if (cache := _cache()) is None:
+        return _memory_incr(key, timeout)
+    try:
+        cache.add(key, 0, timeout)
+        return cache.incr(key)
+    except Exception:
+        # The cache is unavailable or the key has been evicted in between
+        return _memory_incr(key, timeout)
+
+
+def _get(key):
+    if (cache := _cache()) is None:
+        return _memory_get(key)
+    try:
+        return cache.get(key, 0)
+    except Exception:
+        return _memory_get(key)
+
+
+def _set(key, value, timeout):
+    with _memory_lock:
+        _memory_store(key, (time.monotonic() + timeout, value))
+    if (cache := _cache()) is None:
+        return
+    with suppress(Exception):
+        cache.set(key, value, timeout)
+
+
+def _delete(key):
+    with _memory_lock:
+        _memory.pop(key, None)
+    if (cache := _cache()) is None:
+        return
+    with suppress(Exception):
+        cache.delete(key)
+
+
+def _key(scope, ident, window):
+    digest = hashlib.md5(str(ident).encode()).hexdigest()
+    return f"authlib-throttle-{scope}-{digest}-{window}"
+
+
+def hit(scope, ident, *, rate):
+    """
+    Records a hit for ``ident`` and returns whether it is within ``rate``
+
+    ``rate`` is a ``(limit, seconds)`` tuple. The sliding window is
+    approximated using the counters of the current and the previous fixed
+    window, weighting the latter by its overlap with the sliding window.
+    Counters are stored in the cache named by ``AUTHLIB_THROTTLE_CACHE``
+    (default: ``"default"``) and in process memory if the cache fails or the
+    setting is ``None``.
+    """
+    limit, seconds = rate
+    window, offset = divmod(time.time(), seconds)
+    current = _incr(_key(scope, ident, int(window)), 2 * seconds)
+    previous = _get(_key(scope, ident, int(window) - 1))
+    return previous * (1 - offset / seconds) + current <= limit
+
+
+def client_ip(request):
+    return request.META.get("REMOTE_ADDR", "")
+
+
+def is_exempt(request):
+    """
+    Returns whether the client IP is contained in one of the networks in
+    ``AUTHLIB_THROTTLE_EXEMPT``
+    """
+    if not (networks := getattr(settings, "AUTHLIB_THROTTLE_EXEMPT", ())):
+        return False
+    try:
+        ip = ipaddress.ip_address(client_ip(request))
+    except ValueError:
+        return False
+    return any(ip in ipaddress.ip_network(network) for network in networks)
+
+
+def _lockout_key(scope, ident):
+    return _key(scope, ident, "lockout")
+
+
+def locked_out(scope, ident):
+    """
+    Returns the number of seconds ``ident`` is still locked out for, or zero
+    """
+    return max(0, _get(_lockout_key(scope, ident)) - time.time())
+
+
+def fail(scope, ident, *, limit, lockout=60):
+    """
+    Records a failed attempt and locks ``ident`` out once more than ``limit``
+    attempts have failed
+
+    The lockout starts at ``lockout`` seconds and doubles with each further
+    failure up to one day. Failures are forgotten one day after the first.
+    """
+    failures = _incr(_key(scope, ident, "failures"), 86400)
+    if failures > limit:
+        duration = min(lockout * 2 ** (failures - limit - 1), 86400)
+        _set(_lockout_key(scope, ident), time.time() + duration, duration)
+
+
+def reset(scope, ident):
+    _delete(_key(scope, ident, "failures"))
+    _delete(_lockout_key(scope, ident))
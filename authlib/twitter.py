@@ -2,6 +2,8 @@ from django.conf import settings
 from django.core.cache import cache
 from requests_oauthlib import OAuth1Session
 
+from authlib._http import pooled
+
 
 class TwitterOAuthClient:
     authorization_base_url = "https://api.twitter.com/oauth/authenticate"
@@ -14,10 +16,17 @@ class TwitterOAuthClient:
         self._request = request
 
     def get_authentication_url(self):
-        oauth = OAuth1Session(self.client_id, client_secret=self.client_secret)
+        oauth = pooled(
+            OAuth1Session(self.client_id, client_secret=self.client_secret),
+            provider="twitter",
+        )
         token = oauth.fetch_request_token(self.request_token_url)
-        cache.set("oa-token-{}".format(token["oauth_token"]), token, timeout=3600)
-        self._request.session["oa_token"] = token["oauth_token"]
+        # The session is only stored server-side or signed, so there's no
+        # need to involve the cache.
+        self._request.session["oa_token"] = {
+            "oauth_token": token["oauth_token"],
+            "oauth_token_secret": token["oauth_token_secret"],
+        }
 
         authorization_url = oauth.authorization_url(self.authorization_base_url)
 
@@ -25,36 +34,45 @@ class TwitterOAuthClient:
 
     def get_user_data(self):
         oauth = OAuth1Session(self.client_id, client_secret=self.client_secret)
+        # Only parses the URL, no requests are sent using this session
         oauth_response = oauth.parse_authorization_response(
             self._request.build_absolute_uri(self._request.get_full_path())
         )
         verifier = oauth_response.get("oauth_verifier")
 
-        oa_token = self._request.session.pop("oa_token", None)
-        if not oa_token:
-            return {}
-
-        resource_owner = cache.get(f"oa-token-{oa_token}")
+        resource_owner = self._request.session.pop("oa_token", None)
+        if isinstance(resource_owner, str):
+            # Logins started before the token was stored in the session
+            resource_owner = cache.get(f"oa-token-{resource_owner}")
         if not resource_owner:
             return {}
+        if resource_owner.get("oauth_token") != oauth_response.get("oauth_token"):
+            # The callback doesn't belong to the login started in this session
+            return {}
 
-        oauth = OAuth1Session(
-            self.client_id,
-            client_secret=self.client_secret,
-            resource_owner_key=resource_owner.get("oauth_token"),
-            resource_owner_secret=resource_owner.get("oauth_token_secret"),
-            verifier=verifier,
+        oauth = pooled(
+            OAuth1Session(
+                self.client_id,
+                client_secret=self.client_secret,
+                resource_owner_key=resource_owner.get("oauth_token"),
+                resource_owner_secret=resource_owner.get("oauth_token_secret"),
+                verifier=verifier,
+            ),
+            provider="twitter",
         )
         oauth_tokens = oauth.fetch_access_token(self.access_token_url)
 
         resource_owner_key = oauth_tokens.get("oauth_token")
         resource_owner_secret = oauth_tokens.get("oauth_token_secret")
 
-        oauth = OAuth1Session(
-            self.client_id,
-            client_secret=self.client_secret,
-            resource_owner_key=resource_owner_key,
-            resource_owner_secret=resource_owner_secret,
+        oauth = pooled(
+            OAuth1Session(
+                self.client_id,
+                client_secret=self.client_secret,
+                resource_owner_key=resource_owner_key,
+                resource_owner_secret=resource_owner_secret,
+            ),
+            provider="twitter",
         )
 
         data = oauth.get(
@@ -4,7 +4,7 @@ from django import forms
 from django.conf import settings
 from django.contrib import auth, messages
 from django.contrib.auth.forms import AuthenticationForm
-from django.core.exceptions import ValidationError
+from django.core.exceptions import ImproperlyConfigured, ValidationError
 from django.shortcuts import redirect, render
 from django.utils.http import url_has_allowed_host_and_scheme
 from django.utils.text import capfirst
@@ -13,7 +13,10 @@ from django.views.decorators.cache import never_cache
 from django.views.decorators.debug import sensitive_post_parameters
 
 from authlib._compat import login_not_required
+from authlib._http import ProviderUnavailableError
+from authlib.base_user import _users_by_email
 from authlib.email import decode, send_registration_mail
+from authlib.throttling import client_ip, fail, hit, is_exempt, locked_out, reset
 
 
 REDIRECT_COOKIE_NAME = "authlib-next"
@@ -66,7 +69,7 @@ def email_login(request, *, email, **kwargs):
     Returns a tuple consisting of ``(user, created)`` upon success or ``(None,
     None)`` when authentication fails.
     """
-    _u, created = auth.get_user_model()._default_manager.get_or_create(email=email)
+    _u, created = _users_by_email(email).get_or_create(defaults={"email": email})
     user = auth.authenticate(request, email=email)
     if user and user.is_active:  # The is_active check is possibly redundant.
         auth.login(request, user)
@@ -74,6 +77,25 @@ def email_login(request, *, email, **kwargs):
     return None, None
 
 
+def _login_throttles(request):
+    """
+    Returns ``(scope, ident, limit)`` tuples for the failed login limits in
+    ``AUTHLIB_LOGIN_LIMITS`` applying to this request
+    """
+    limits = getattr(settings, "AUTHLIB_LOGIN_LIMITS", None) or {}
+    if unknown := set(limits) - {"ip", "username"}:
+        raise ImproperlyConfigured(
+            f"AUTHLIB_LOGIN_LIMITS contains unknown scopes: {sorted(unknown)}"
+        )
+    if request.method != "POST" or not limits or is_exempt(request):
+        return []
+    idents = {
+        "ip": client_ip(request),
+        "username": request.POST.get("username", "").lower(),
+    }
+    return [(f"login-{scope}", idents[scope], limit) for scope, limit in limits.items()]
+
+
 @login_not_required
 @never_cache
 @sensitive_post_parameters()
@@ -85,12 +107,28 @@ def login(
     authentication_form=AuthenticationForm,
     post_login_response=post_login_response,
 ):
+    throttles = _login_throttles(request)
+    if any(locked_out(scope, ident) for scope, ident, _limit in throttles):
+        messages.error(
+            request, _("Too many failed login attempts. Please try again later.")
+        )
+        form = authentication_form(
+            request=request, initial={"username": request.POST.get("username")}
+        )
+        return render(request, template_name, {"form": form}, status=429)
+
     form = authentication_form(
         data=request.POST if request.method == "POST" else None, request=request
     )
     if form.is_valid():
+        for scope, ident, _limit in throttles:
+            if scope == "login-username":
+                reset(scope, ident)
         auth.login(request, form.get_user())
         return post_login_response(request, new_user=False)
+    lockout = getattr(settings, "AUTHLIB_LOGIN_LOCKOUT", 60)
+    for scope, ident, limit in throttles:
+        fail(scope, ident, limit=limit, lockout=lockout)
     return render(request, template_name, {"form": form})
 
 
@@ -105,11 +143,16 @@ def oauth2(
 ):
     client = client_class(request)
 
-    if all(key not in request.GET for key in ("code", "oauth_token")):
-        return redirect(client.get_authentication_url())
-
     try:
+        if all(key not in request.GET for key in ("code", "oauth_token")):
+            return redirect(client.get_authentication_url())
         user_data = client.get_user_data()
+    except ProviderUnavailableError:
+        messages.error(
+            request,
+            _("The login provider is currently unavailable. Please try again later."),
+        )
+        return redirect("login")
     except Exception as exc:
         messages.error(request, exc)
         messages.error(request, _("Error while fetching user data. Please try again."))
@@ -144,7 +187,7 @@ class EmailRegistrationForm(forms.Form):
             email
             and (u := self.request.user)
             and u.is_authenticated
-            and email != u.email
+            and email.lower() != u.email.lower()
         ):
             raise forms.ValidationError(
                 _(
@@ -162,6 +205,21 @@ class EmailRegistrationForm(forms.Form):
         )
 
 
+def _registration_throttled(request, email):
+    """
+    Counts a registration mail for the client IP and the email address and
+    returns whether one of the rates in ``AUTHLIB_REGISTRATION_RATES`` has
+    been exceeded
+    """
+    rates = getattr(settings, "AUTHLIB_REGISTRATION_RATES", None) or {}
+    hits = [
+        hit(f"registration-{scope}", ident, rate=rate)
+        for scope, ident in [("ip", client_ip(request)), ("email", email.lower())]
+        if (rate := rates.get(scope))
+    ]
+    return not all(hits)
+
+
 @login_not_required
 @never_cache
 def email_registration(
@@ -178,7 +236,8 @@ def email_registration(
             request.POST if request.method == "POST" else None, request=request
         )
         if form.is_valid():
-            form.send_mail()
+            if not _registration_throttled(request, form.cleaned_data["email"]):
+                form.send_mail()
             messages.success(request, _("Please check your mailbox."))
             return redirect(".")
         return render(request, "registration/email_registration.html", {"form": form})
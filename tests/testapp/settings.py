@@ -16,6 +16,7 @@ INSTALLED_APPS = [
     "authlib",
     "authlib.admin_oauth",
     "authlib.little_auth",
+    "authlib.outbox",
     "django.contrib.admin",
 ]
 
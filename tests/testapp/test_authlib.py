@@ -1,18 +1,32 @@
-import base64
-import json
+import time
 from contextlib import contextmanager
 from unittest import skipUnless
 from unittest.mock import patch
 from urllib.parse import parse_qsl, urlparse
 
+import jwt
+import requests
 import requests_mock
-from django.test import Client, TestCase
-from django.test.utils import isolate_apps, modify_settings
+from cryptography.hazmat.primitives.asymmetric import rsa
+from django.contrib.auth.hashers import MD5PasswordHasher
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, transaction
+from django.test import Client, RequestFactory, TestCase
+from django.test.utils import isolate_apps, modify_settings, override_settings
 from django.utils.translation import deactivate_all
+from jwt.algorithms import RSAAlgorithm
 
+from authlib import jwks
+from authlib._http import _breakers
+from authlib.backends import EmailBackend, _user_cache_key
 from authlib.base_user import BaseUser
 from authlib.facebook import FacebookOAuth2Client
+from authlib.google import GoogleOAuth2Client
 from authlib.little_auth.models import User
+from authlib.oidc import _discovery, discover
+from authlib.throttling import locked_out
+from authlib.twitter import TwitterOAuthClient
 
 
 try:
@@ -24,22 +38,46 @@ except ImportError:
     has_login_required_middleware = False
 
 
+_private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+JWKS = {
+    "keys": [
+        {
+            **RSAAlgorithm.to_jwk(_private_key.public_key(), as_dict=True),
+            "kid": "test",
+            "alg": "RS256",
+            "use": "sig",
+        }
+    ]
+}
+
+
+def id_token(claims, *, kid="test"):
+    return jwt.encode(
+        {
+            "iss": "https://accounts.google.com",
+            "aud": "empty",
+            "exp": int(time.time()) + 60,
+            **claims,
+        },
+        _private_key,
+        algorithm="RS256",
+        headers={"kid": kid},
+    )
+
+
 @contextmanager
 def google_oauth_data(data):
     with requests_mock.Mocker() as m:
-        jwt = (
-            base64.urlsafe_b64encode(json.dumps(data).encode("utf-8"))
-            .replace(b"=", b"")
-            .decode("utf-8")
+        m.get(
+            GoogleOAuth2Client.jwks_url,
+            json=JWKS,
+            headers={"Cache-Control": "public, max-age=3600"},
         )
         m.post(
             "https://www.googleapis.com/oauth2/v4/token",
-            json={
-                "access_token": "123",
-                "id_token": f"header.{jwt}.signature",
-            },
+            json={"access_token": "123", "id_token": id_token(data)},
         )
-        yield
+        yield m
 
 
 @contextmanager
@@ -260,6 +298,21 @@ class OAuth2Test(TestCase):
         self.assertEqual(params["redirect_uri"], "http://testserver/oauth/google/")
         self.assertEqual(params["scope"], "openid email profile")
 
+    def test_pooled_sessions(self):
+        request = RequestFactory().get("/oauth/facebook/")
+        first = FacebookOAuth2Client(request)._session
+        second = FacebookOAuth2Client(request)._session
+        self.assertIsNot(first, second)
+        adapter = first.get_adapter("https://graph.facebook.com/")
+        self.assertIs(adapter, second.get_adapter("https://graph.facebook.com/"))
+        self.assertEqual(adapter._pool_maxsize, 10)
+
+        with override_settings(AUTHLIB_HTTP_POOL_SIZE=50):
+            adapter = FacebookOAuth2Client(request)._session.get_adapter(
+                "https://graph.facebook.com/"
+            )
+            self.assertEqual(adapter._pool_maxsize, 50)
+
     def test_oauth2_no_data(self):
         client = Client()
 
@@ -292,6 +345,27 @@ class OAuth2Test(TestCase):
             messages, ["No active user with email address test4@example.com found."]
         )
 
+    def test_oauth2_email_case_insensitive(self):
+        user = User.objects.create(email="Test5@example.com")
+        client = Client()
+
+        with google_oauth_data({"email": "test5@EXAMPLE.com", "email_verified": True}):
+            response = client.get("/oauth/google/?code=bla")
+        self.assertRedirects(response, "/?login=1", fetch_redirect_response=False)
+        self.assertEqual(list(User.objects.all()), [user])
+        self.assertEqual(client.session["_auth_user_id"], str(user.pk))
+
+    def test_email_unique_case_insensitive(self):
+        User.objects.create_user("test6@example.com", "blabla")
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            User.objects.create(email="TEST6@example.com")
+
+        client = Client()
+        response = client.post(
+            "/login/", {"username": "Test6@Example.com", "password": "blabla"}
+        )
+        self.assertRedirects(response, "/?login=1", fetch_redirect_response=False)
+
     @skipUnless(
         has_login_required_middleware, "LoginRequiredMiddleware needs Django 5.1+"
     )
@@ -305,3 +379,441 @@ class OAuth2Test(TestCase):
 
         response = client.get("/email/")
         self.assertEqual(response.status_code, 200)
+
+
+@override_settings(AUTHLIB_USER_CACHE="default")
+class UserCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_cached_get_user(self):
+        user = User.objects.create(email="test@example.com", full_name="Test")
+        backend = EmailBackend()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(backend.get_user(user.pk), user)
+        with self.assertNumQueries(0):
+            cached = backend.get_user(user.pk)
+            self.assertEqual(cached, user)
+            self.assertEqual(cached.full_name, "Test")
+            self.assertFalse(cached._state.adding)
+
+        user.is_active = False
+        user.save()
+        self.assertIsNone(backend.get_user(user.pk))
+
+        user.is_active = True
+        user.save()
+        self.assertEqual(backend.get_user(user.pk), user)
+        user.delete()
+        self.assertIsNone(backend.get_user(user.pk))
+
+    def test_invalidate_on_commit(self):
+        user = User.objects.create(email="test@example.com")
+        backend = EmailBackend()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            user.is_active = False
+            user.save()
+            # A concurrent request still sees the committed active user
+            cache.set(
+                _user_cache_key(User, user.pk),
+                {"id": user.pk, "email": user.email, "is_active": True},
+            )
+            self.assertIsNotNone(backend.get_user(user.pk))
+        self.assertIsNone(backend.get_user(user.pk))
+
+    @override_settings(AUTHLIB_USER_CACHE_FIELDS=["email", "is_active"])
+    def test_cached_fields(self):
+        user = User.objects.create(email="test@example.com", full_name="Test")
+        backend = EmailBackend()
+        backend.get_user(user.pk)
+
+        with self.assertNumQueries(0):
+            cached = backend.get_user(user.pk)
+            self.assertEqual(cached.email, "test@example.com")
+        with self.assertNumQueries(1):
+            self.assertEqual(cached.full_name, "Test")
+
+    @override_settings(AUTHLIB_USER_CACHE_FIELDS=["is_active", "email"])
+    def test_cached_fields_order(self):
+        user = User.objects.create(email="test@example.com")
+        backend = EmailBackend()
+        backend.get_user(user.pk)
+
+        with self.assertNumQueries(0):
+            cached = backend.get_user(user.pk)
+            self.assertEqual(cached.pk, user.pk)
+            self.assertEqual(cached.email, "test@example.com")
+            self.assertIsInstance(cached.is_active, bool)
+            self.assertTrue(cached.is_active)
+
+
+@override_settings(
+    AUTHLIB_LOGIN_LIMITS={"ip": 5, "username": 2},
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+)
+class LoginThrottleTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("admin@example.com", "blabla")
+
+    def _login(self, password, **kwargs):
+        return self.client.post(
+            "/login/",
+            {"username": "admin@example.com", "password": password},
+            **kwargs,
+        )
+
+    def test_lockout_before_hashing(self):
+        with patch.object(
+            MD5PasswordHasher,
+            "verify",
+            autospec=True,
+            side_effect=MD5PasswordHasher.verify,
+        ) as verify:
+            self.assertEqual(self._login("wrong").status_code, 200)
+            self.assertEqual(self._login("wrong").status_code, 200)
+            # The third failure locks the username out
+            self.assertEqual(self._login("wrong").status_code, 200)
+            self.assertTrue(verify.called)
+            verify.reset_mock()
+
+            response = self._login("blabla")
+            self.assertEqual(response.status_code, 429)
+            # The password hasn't been checked
+            self.assertFalse(verify.called)
+
+        # Also from other addresses
+        response = self._login("blabla", REMOTE_ADDR="10.0.0.1")
+        self.assertEqual(response.status_code, 429)
+
+        with patch("authlib.throttling.time.time", return_value=time.time() + 61):
+            response = self._login("blabla")
+        self.assertRedirects(response, "/?login=1", fetch_redirect_response=False)
+
+    @override_settings(AUTHLIB_LOGIN_LIMITS={"ip": 5, "usernmae": 2})
+    def test_unknown_scope(self):
+        with self.assertRaisesRegex(ImproperlyConfigured, "usernmae"):
+            self.client.get("/login/")
+
+    def test_exponential_lockout(self):
+        for _i in range(3):
+            self._login("wrong")
+        now = time.time()
+        self.assertAlmostEqual(
+            locked_out("login-username", "admin@example.com"), 60, delta=2
+        )
+        with patch("authlib.throttling.time.time", return_value=now + 61):
+            self._login("wrong")
+        self.assertAlmostEqual(
+            locked_out("login-username", "admin@example.com"), 61 + 120, delta=2
+        )
+
+    def test_ip_limit(self):
+        for i in range(6):
+            self.client.post("/login/", {"username": f"{i}@example.com"})
+        self.assertEqual(self._login("blabla").status_code, 429)
+        self.assertRedirects(
+            self._login("blabla", REMOTE_ADDR="10.0.0.1"),
+            "/?login=1",
+            fetch_redirect_response=False,
+        )
+
+    @override_settings(AUTHLIB_THROTTLE_EXEMPT=["127.0.0.0/8"])
+    def test_exempt(self):
+        for _i in range(5):
+            self._login("wrong")
+        self.assertRedirects(
+            self._login("blabla"), "/?login=1", fetch_redirect_response=False
+        )
+
+
+class JWKSTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        jwks._key_sets.clear()
+
+    def test_verify_id_token(self):
+        with google_oauth_data({}) as m:
+            claims = GoogleOAuth2Client.verify_id_token(id_token({"email": "a@b.c"}))
+            self.assertEqual(claims["email"], "a@b.c")
+            GoogleOAuth2Client.verify_id_token(id_token({}))
+            self.assertEqual(m.call_count, 1)
+
+            for token in [
+                id_token({"aud": "other"}),
+                id_token({"iss": "https://example.com"}),
+                id_token({"exp": int(time.time()) - 10}),
+                id_token({})[:-4] + "AAAA",
+            ]:
+                with (
+                    self.subTest(token=token),
+                    self.assertRaises(jwt.InvalidTokenError),
+                ):
+                    GoogleOAuth2Client.verify_id_token(token)
+
+            self.assertEqual(
+                GoogleOAuth2Client.verify_id_token(
+                    id_token({"aud": "mobile"}), audience="mobile"
+                )["aud"],
+                "mobile",
+            )
+            self.assertEqual(m.call_count, 1)
+
+        # The key set is also available to other processes
+        jwks._key_sets.clear()
+        GoogleOAuth2Client.verify_id_token(id_token({}))
+
+    def test_unknown_kid(self):
+        with google_oauth_data({}) as m:
+            GoogleOAuth2Client.verify_id_token(id_token({}))
+            # Unknown key IDs do not refresh the key set too often
+            with self.assertRaises(jwt.InvalidTokenError):
+                GoogleOAuth2Client.verify_id_token(id_token({}, kid="new"))
+            self.assertEqual(m.call_count, 1)
+
+            with patch("authlib.jwks.time.time", return_value=time.time() + 61):
+                with self.assertRaises(jwt.InvalidTokenError):
+                    GoogleOAuth2Client.verify_id_token(id_token({}, kid="new"))
+                self.assertEqual(m.call_count, 2)
+
+    def test_without_crypto(self):
+        with patch("authlib.google.jwks", None):
+            with self.assertRaisesRegex(ImproperlyConfigured, "cryptography"):
+                GoogleOAuth2Client.verify_id_token(id_token({}))
+
+            # The ID token received directly from Google is decoded without
+            # verification
+            with google_oauth_data({"email": "a@b.c", "email_verified": True}) as m:
+                client = GoogleOAuth2Client(RequestFactory().get("/?code=bla"))
+                self.assertEqual(client.get_user_data()["email"], "a@b.c")
+                self.assertEqual(m.call_count, 1)
+
+    def test_max_age(self):
+        with google_oauth_data({}) as m:
+            m.get(
+                GoogleOAuth2Client.jwks_url,
+                json=JWKS,
+                headers={"Cache-Control": "public, max-age=5"},
+            )
+            GoogleOAuth2Client.verify_id_token(id_token({}))
+            with patch("authlib.jwks.time.time", return_value=time.time() + 10):
+                GoogleOAuth2Client.verify_id_token(id_token({}))
+            self.assertEqual(m.call_count, 2)
+
+
+ISSUER = "https://sso.example.com/realms/test"
+
+
+@contextmanager
+def oidc_provider(claims):
+    with requests_mock.Mocker() as m:
+        m.get(
+            f"{ISSUER}/.well-known/openid-configuration",
+            json={
+                "issuer": ISSUER,
+                "authorization_endpoint": f"{ISSUER}/auth",
+                "token_endpoint": f"{ISSUER}/token",
+                "jwks_uri": f"{ISSUER}/certs",
+            },
+        )
+        m.get(f"{ISSUER}/certs", json=JWKS)
+        m.post(
+            f"{ISSUER}/token",
+            json={
+                "access_token": "123",
+                "id_token": id_token({"iss": ISSUER, **claims}),
+            },
+        )
+        yield m
+
+
+class OIDCTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        _discovery.clear()
+        jwks._key_sets.clear()
+
+    def test_login(self):
+        with oidc_provider({"email": "oidc@example.com", "email_verified": True}) as m:
+            response = self.client.get("/oauth/oidc/")
+            self.assertTrue(response["Location"].startswith(f"{ISSUER}/auth?"))
+
+            response = self.client.get("/oauth/oidc/?code=bla")
+            self.assertRedirects(response, "/?login=1", fetch_redirect_response=False)
+            self.assertTrue(User.objects.filter(email="oidc@example.com").exists())
+
+            # Discovery and key set requests happen only once
+            self.assertEqual(
+                [r.path for r in m.request_history],
+                [
+                    "/realms/test/.well-known/openid-configuration",
+                    "/realms/test/token",
+                    "/realms/test/certs",
+                ],
+            )
+
+            # Other processes use the cached metadata
+            _discovery.clear()
+            self.client.get("/oauth/oidc/")
+            self.assertEqual(m.call_count, 3)
+
+    def test_unverified_email(self):
+        with oidc_provider({"email": "oidc@example.com"}):
+            response = self.client.get("/oauth/oidc/?code=bla")
+        self.assertRedirects(response, "/login/", fetch_redirect_response=False)
+        self.assertFalse(User.objects.filter(email="oidc@example.com").exists())
+
+    def test_wrong_issuer(self):
+        with oidc_provider({"iss": "https://evil.example.com", "email_verified": True}):
+            response = self.client.get("/oauth/oidc/?code=bla")
+        self.assertRedirects(response, "/login/", fetch_redirect_response=False)
+
+    def test_metadata_issuer_mismatch(self):
+        with oidc_provider({}) as m:
+            m.get(
+                f"{ISSUER}/.well-known/openid-configuration",
+                json={"issuer": "https://evil.example.com", "jwks_uri": f"{ISSUER}/x"},
+            )
+            with self.assertRaisesRegex(ImproperlyConfigured, "does not match"):
+                discover(ISSUER)
+        self.assertEqual(_discovery, {})
+
+
+@contextmanager
+def twitter_provider():
+    with requests_mock.Mocker() as m:
+        m.post(
+            TwitterOAuthClient.request_token_url,
+            text="oauth_token=abc&oauth_token_secret=def&oauth_callback_confirmed=true",
+        )
+        m.post(
+            TwitterOAuthClient.access_token_url,
+            text="oauth_token=ghi&oauth_token_secret=jkl",
+        )
+        m.get(
+            "https://api.twitter.com/1.1/account/verify_credentials.json",
+            json={"email": "twitter@example.com", "name": "Twitter"},
+        )
+        yield m
+
+
+class TwitterTest(TestCase):
+    def test_login_without_cache(self):
+        with twitter_provider(), patch("authlib.twitter.cache") as twitter_cache:
+            response = self.client.get("/oauth/twitter/")
+            self.assertTrue(
+                response["Location"].startswith(
+                    "https://api.twitter.com/oauth/authenticate?oauth_token=abc"
+                )
+            )
+            response = self.client.get(
+                "/oauth/twitter/?oauth_token=abc&oauth_verifier=verifier"
+            )
+        self.assertRedirects(response, "/?login=1", fetch_redirect_response=False)
+        self.assertEqual(twitter_cache.mock_calls, [])
+        self.assertTrue(User.objects.filter(email="twitter@example.com").exists())
+
+    def test_token_mismatch(self):
+        with twitter_provider():
+            self.client.get("/oauth/twitter/")
+            response = self.client.get(
+                "/oauth/twitter/?oauth_token=other&oauth_verifier=verifier"
+            )
+        self.assertRedirects(response, "/login/", fetch_redirect_response=False)
+        self.assertFalse(User.objects.filter(email="twitter@example.com").exists())
+
+    def test_legacy_cache_entry(self):
+        cache.set(
+            "oa-token-abc", {"oauth_token": "abc", "oauth_token_secret": "def"}, 60
+        )
+        session = self.client.session
+        session["oa_token"] = "abc"
+        session.save()
+        with twitter_provider():
+            response = self.client.get(
+                "/oauth/twitter/?oauth_token=abc&oauth_verifier=verifier"
+            )
+        self.assertRedirects(response, "/?login=1", fetch_redirect_response=False)
+
+
+class CircuitBreakerTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        _breakers.clear()
+        _discovery.clear()
+        jwks._key_sets.clear()
+
+    def _messages(self, response):
+        return [str(m) for m in response.wsgi_request._messages]
+
+    def test_timeouts(self):
+        with google_oauth_data({}) as m:
+            self.client.get("/oauth/google/?code=bla")
+            # The token and the key set request
+            self.assertEqual([r.timeout for r in m.request_history], [(3.05, 10)] * 2)
+
+            with override_settings(AUTHLIB_PROVIDER_TIMEOUTS={"google": (1, 2)}):
+                self.client.get("/oauth/google/?code=bla")
+            self.assertEqual(m.request_history[-1].timeout, (1, 2))
+
+    @override_settings(AUTHLIB_PROVIDER_TIMEOUTS={ISSUER: (1, 2)})
+    def test_oidc_timeouts(self):
+        with oidc_provider({"email_verified": True}) as m:
+            self.client.get("/oauth/oidc/?code=bla")
+            # Discovery, token and key set requests
+            self.assertEqual([r.timeout for r in m.request_history], [(1, 2)] * 3)
+
+    @override_settings(AUTHLIB_CIRCUIT_BREAKER={"failures": 1, "cooldown": 10})
+    def test_discovery_circuit_breaker(self):
+        with requests_mock.Mocker() as m:
+            m.get(f"{ISSUER}/.well-known/openid-configuration", status_code=503)
+            response = self.client.get("/oauth/oidc/")
+            self.assertEqual(m.call_count, 1)
+            response = self.client.get("/oauth/oidc/")
+            self.assertEqual(m.call_count, 1)
+            self.assertEqual(
+                self._messages(response)[-1],
+                "The login provider is currently unavailable. Please try again later.",
+            )
+
+    def _check_breaker(self):
+        with requests_mock.Mocker() as m:
+            m.post(
+                FacebookOAuth2Client.token_url, exc=requests.exceptions.ConnectTimeout
+            )
+            for _i in range(3):
+                response = self.client.get("/oauth/facebook/?code=bla")
+                self.assertIn(
+                    "Error while fetching user data. Please try again.",
+                    self._messages(response),
+                )
+            self.assertEqual(m.call_count, 3)
+
+            response = self.client.get("/oauth/facebook/?code=bla")
+            self.assertEqual(m.call_count, 3)
+            self.assertRedirects(response, "/login/", fetch_redirect_response=False)
+            self.assertEqual(
+                self._messages(response)[-1],
+                "The login provider is currently unavailable. Please try again later.",
+            )
+
+            # Other providers are unaffected
+            self.assertEqual(self.client.get("/oauth/google/").status_code, 302)
+
+            with patch("authlib._http.time.time", return_value=time.time() + 11):
+                self.client.get("/oauth/facebook/?code=bla")
+            self.assertEqual(m.call_count, 4)
+
+    @override_settings(AUTHLIB_CIRCUIT_BREAKER={"failures": 3, "cooldown": 10})
+    def test_circuit_breaker(self):
+        self._check_breaker()
+
+    @override_settings(
+        AUTHLIB_CIRCUIT_BREAKER={"failures": 3, "cooldown": 10},
+        AUTHLIB_CIRCUIT_BREAKER_CACHE="default",
+    )
+    def test_circuit_breaker_cache(self):
+        self._check_breaker()
+        self.assertEqual(_breakers, {})
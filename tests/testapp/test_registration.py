@@ -1,20 +1,33 @@
+import io
 import re
+import tempfile
 import time
+from unittest.mock import patch
 from urllib.parse import unquote
 
-from django.core import mail
+from django.core import mail, signing
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.signals import request_finished, request_started
+from django.template.loader import TemplateDoesNotExist, select_template
 from django.test import Client, TestCase
 from django.test.client import RequestFactory
+from django.test.utils import override_settings
 from django.utils import timezone
 
 from authlib.email import (
+    _templates,
     decode,
     get_confirmation_code,
+    get_signer,
     render_to_mail,
     send_registration_mail,
+    send_registration_mails,
 )
 from authlib.little_auth.models import User
+from authlib.outbox.models import Message, send_queued
+from authlib.throttling import _memory, hit
 
 
 def _messages(response):
@@ -105,6 +118,22 @@ class RegistrationTest(TestCase):
         mail = render_to_mail("empty", {})
         self.assertEqual(mail.subject, "")
 
+    def test_render_to_mail_template_cache(self):
+        _templates.clear()
+        with patch(
+            "authlib.email.select_template", side_effect=select_template
+        ) as selected:
+            render_to_mail("registration/email_registration_email", {"url": "/"})
+            message = render_to_mail(
+                "registration/email_registration_email", {"url": "/"}
+            )
+        self.assertEqual(message.alternatives, [])
+        # The text template and the missing HTML template are only looked up once
+        self.assertEqual(selected.call_count, 2)
+
+        with self.assertRaises(TemplateDoesNotExist):
+            render_to_mail("missing", {})
+
     def test_payload(self):
         self.client.post("/custom/", {"email": "test42@example.com"})
 
@@ -131,3 +160,319 @@ class RegistrationTest(TestCase):
             cm.exception.messages,
             ["The link is expired. Please request another registration link."],
         )
+
+    def test_signer(self):
+        code = get_confirmation_code("test@example.com", payload="hello")
+        # Compatible with Django's signer
+        self.assertEqual(
+            signing.TimestampSigner(salt="email_registration").unsign(code),
+            code.rsplit(":", 2)[0],
+        )
+        self.assertIs(get_signer(), get_signer())
+
+    def test_key_rotation(self):
+        code = get_confirmation_code("test@example.com")
+
+        with override_settings(SECRET_KEY="new", SECRET_KEY_FALLBACKS=["supersikret"]):
+            with self.assertLogs("authlib.email", "INFO") as cm:
+                self.assertEqual(decode(code, max_age=5), ["test@example.com", ""])
+            self.assertEqual(
+                cm.output,
+                [
+                    "INFO:authlib.email:Confirmation code verified using"
+                    " SECRET_KEY_FALLBACKS[0]"
+                ],
+            )
+
+            new_code = get_confirmation_code("test@example.com")
+            self.assertNotEqual(code, new_code)
+            with self.assertNoLogs("authlib.email"):
+                self.assertEqual(decode(new_code, max_age=5), ["test@example.com", ""])
+
+        with (
+            override_settings(SECRET_KEY="new"),
+            self.assertRaises(ValidationError) as cm,
+        ):
+            decode(code, max_age=5)
+        self.assertEqual(cm.exception.code, "email_registration_signature")
+
+    def test_compact_codes(self):
+        code = get_confirmation_code("test@example.com", payload="hello")
+        with override_settings(AUTHLIB_COMPACT_CODES=True):
+            compact = get_confirmation_code("test@example.com", payload="hello")
+            self.assertLess(len(compact), len(code) - 20)
+            self.assertNotIn(":", compact)
+
+            # Both formats are accepted
+            self.assertEqual(decode(code, max_age=5), ["test@example.com", "hello"])
+            self.assertEqual(decode(compact, max_age=5), ["test@example.com", "hello"])
+
+            for invalid in [
+                compact.replace("dGVz", "dGVa", 1),
+                compact[:-1],
+                compact + "A",
+                compact.rsplit(".", 1)[0],
+            ]:
+                with self.subTest(code=invalid), self.assertRaises(ValidationError):
+                    decode(invalid, max_age=5)
+
+            with self.assertRaises(ValidationError) as cm:
+                time.sleep(2)
+                decode(compact, max_age=1)
+            self.assertEqual(cm.exception.code, "email_registration_expired")
+
+            with override_settings(
+                SECRET_KEY="new", SECRET_KEY_FALLBACKS=["supersikret"]
+            ):
+                self.assertEqual(
+                    decode(compact, max_age=5), ["test@example.com", "hello"]
+                )
+
+            self.client.post("/custom/", {"email": "test42@example.com"})
+            url = unquote(
+                [
+                    line
+                    for line in mail.outbox[0].body.splitlines()
+                    if "/custom/" in line
+                ][0]
+            )
+            self.assertEqual(
+                self.client.get(url).content,
+                b"email:test42@example.com payload:hello:world:42",
+            )
+
+    @override_settings(AUTHLIB_COMPACT_CODES=True, AUTHLIB_CODE_PAYLOAD_CACHE="default")
+    def test_compact_codes_payload_cache(self):
+        payload = "x" * 1000
+        code = get_confirmation_code("test@example.com", payload=payload)
+        self.assertLess(len(code), 100)
+        self.assertEqual(decode(code, max_age=5), ["test@example.com", payload])
+
+        # Short payloads are kept in the code
+        self.assertEqual(
+            decode(get_confirmation_code("test@example.com", payload="x"), max_age=5),
+            ["test@example.com", "x"],
+        )
+
+        cache.clear()
+        with self.assertRaises(ValidationError) as cm:
+            decode(code, max_age=5)
+        self.assertEqual(cm.exception.code, "email_registration_expired")
+
+    def test_send_registration_mails(self):
+        request = RequestFactory().get("/")
+        failures = send_registration_mails(
+            (f"test{i}@example.com" for i in range(5)),
+            request=request,
+            batch_size=2,
+        )
+        self.assertEqual(failures, {})
+        self.assertEqual(
+            [m.to for m in mail.outbox], [[f"test{i}@example.com"] for i in range(5)]
+        )
+
+        mail.outbox = []
+        failures = send_registration_mails(
+            ["ok@example.com", "broken\n@example.com"], request=request
+        )
+        self.assertEqual(list(failures), ["broken\n@example.com"])
+        self.assertEqual([m.to for m in mail.outbox], [["ok@example.com"]])
+
+        mail.outbox = []
+        with patch(
+            "django.core.mail.backends.locmem.EmailBackend.open",
+            side_effect=[OSError("Connection refused"), None],
+        ):
+            failures = send_registration_mails(
+                (f"test{i}@example.com" for i in range(3)),
+                request=request,
+                batch_size=2,
+            )
+        self.assertEqual(list(failures), ["test0@example.com", "test1@example.com"])
+        self.assertIsInstance(failures["test0@example.com"], OSError)
+        self.assertEqual([m.to for m in mail.outbox], [["test2@example.com"]])
+
+    @override_settings(ALLOWED_HOSTS=["example.com"])
+    def test_send_registration_mails_command(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as f:
+            f.write("test1@example.com\n\ntest2@example.com\n")
+            f.flush()
+            stdout = io.StringIO()
+            call_command(
+                "send_registration_mails",
+                f.name,
+                base_url="https://example.com",
+                stdout=stdout,
+            )
+        self.assertEqual(stdout.getvalue(), "Sent 2 of 2 registration mails.\n")
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertIn("https://example.com/email/", mail.outbox[0].body)
+
+
+class OutboxTest(TestCase):
+    @override_settings(AUTHLIB_MAIL_OUTBOX=True)
+    def test_enqueue_and_send(self):
+        client = Client()
+        client.post("/email/", {"email": "test@example.com"})
+        self.assertEqual(len(mail.outbox), 0)
+
+        message = Message.objects.get()
+        self.assertEqual(message.to, ["test@example.com"])
+        self.assertIn("http://testserver/email/", message.body)
+
+        self.assertEqual(send_queued(), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].body, message.body)
+        self.assertEqual(send_queued(), (0, 0))
+
+        message.refresh_from_db()
+        self.assertEqual(message.attempts, 1)
+        self.assertIsNotNone(message.sent_at)
+
+    def test_retry(self):
+        message = Message.objects.enqueue(
+            mail.EmailMessage("Subject", "Body", to=["test@example.com"])
+        )
+        with patch(
+            "django.core.mail.backends.locmem.EmailBackend.send_messages",
+            side_effect=OSError("Connection refused"),
+        ):
+            self.assertEqual(send_queued(), (0, 1))
+
+        message.refresh_from_db()
+        self.assertEqual(message.attempts, 1)
+        self.assertIsNone(message.sent_at)
+        self.assertGreater(message.next_attempt_at, timezone.now())
+        self.assertEqual(message.last_error, "OSError: Connection refused")
+
+        # Not due yet
+        self.assertEqual(send_queued(), (0, 0))
+
+        Message.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(send_queued(max_attempts=1), (0, 0))
+        out = io.StringIO()
+        call_command("send_outbox", stdout=out)
+        self.assertEqual(out.getvalue(), "Sent 1 mails, 0 failed.\n")
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_connection_failure(self):
+        message = Message.objects.enqueue(
+            mail.EmailMessage("Subject", "Body", to=["test@example.com"])
+        )
+        with patch(
+            "django.core.mail.backends.locmem.EmailBackend.open",
+            side_effect=OSError("Connection refused"),
+        ):
+            self.assertEqual(send_queued(), (0, 1))
+
+        message.refresh_from_db()
+        self.assertEqual(message.attempts, 1)
+        self.assertGreater(message.next_attempt_at, timezone.now())
+        self.assertEqual(message.last_error, "OSError: Connection refused")
+
+
+@override_settings(AUTHLIB_MAIL_DEFER=True)
+class DeferredMailTest(TestCase):
+    def test_deferred(self):
+        request = RequestFactory().get("/")
+        # Outside requests mails are sent immediately
+        send_registration_mail("test@example.com", request=request)
+        self.assertEqual(len(mail.outbox), 1)
+
+        request_started.send(sender=None)
+        send_registration_mail("test1@example.com", request=request)
+        send_registration_mail("test2@example.com", request=request)
+        self.assertEqual(len(mail.outbox), 1)
+        request_finished.send(sender=None)
+        self.assertEqual(
+            [m.to for m in mail.outbox],
+            [["test@example.com"], ["test1@example.com"], ["test2@example.com"]],
+        )
+
+        client = Client()
+        client.post("/email/", {"email": "test3@example.com"})
+        self.assertEqual(len(mail.outbox), 4)
+
+    def test_errors_are_logged(self):
+        request_started.send(sender=None)
+        send_registration_mail("test@example.com", request=RequestFactory().get("/"))
+        with (
+            patch(
+                "django.core.mail.backends.locmem.EmailBackend.send_messages",
+                side_effect=OSError("Connection refused"),
+            ),
+            self.assertLogs("authlib.email", "ERROR") as cm,
+        ):
+            request_finished.send(sender=None)
+        self.assertIn("test@example.com", cm.output[0])
+
+    def test_connection_errors_are_logged(self):
+        request_started.send(sender=None)
+        send_registration_mail("test@example.com", request=RequestFactory().get("/"))
+        with (
+            patch(
+                "django.core.mail.backends.locmem.EmailBackend.open",
+                side_effect=OSError("Connection refused"),
+            ),
+            self.assertLogs("authlib.email", "ERROR") as cm,
+        ):
+            request_finished.send(sender=None)
+        self.assertIn("test@example.com", cm.output[0])
+        self.assertEqual(len(mail.outbox), 0)
+
+
+class ThrottlingTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        _memory.clear()
+
+    @override_settings(AUTHLIB_REGISTRATION_RATES={"ip": (3, 60), "email": (1, 60)})
+    def test_registration_throttling(self):
+        for email in ["a@example.com", "A@example.com", "b@example.com"]:
+            response = self.client.post("/email/", {"email": email}, follow=True)
+            self.assertEqual(_messages(response)[-1], "Please check your mailbox.")
+        self.assertEqual(
+            [m.to for m in mail.outbox], [["a@example.com"], ["b@example.com"]]
+        )
+
+        self.client.post("/email/", {"email": "c@example.com"})
+        self.client.post("/email/", {"email": "d@example.com"}, REMOTE_ADDR="10.0.0.1")
+        self.assertEqual(
+            [m.to for m in mail.outbox],
+            [["a@example.com"], ["b@example.com"], ["d@example.com"]],
+        )
+
+    def test_sliding_window(self):
+        with patch("authlib.throttling.time.time", return_value=120):
+            self.assertEqual(
+                [hit("test", "x", rate=(2, 60)) for _i in range(3)], [True, True, False]
+            )
+        # A sixth of the previous window still counts
+        with patch("authlib.throttling.time.time", return_value=230):
+            self.assertEqual(
+                [hit("test", "x", rate=(2, 60)) for _i in range(2)], [True, False]
+            )
+        with patch("authlib.throttling.time.time", return_value=300):
+            self.assertTrue(hit("test", "x", rate=(2, 60)))
+
+    def test_memory_fallback(self):
+        with override_settings(AUTHLIB_THROTTLE_CACHE=None):
+            self.assertEqual(
+                [hit("test", "x", rate=(1, 60)) for _i in range(2)], [True, False]
+            )
+        self.assertTrue(hit("test", "x", rate=(1, 60)))
+
+        with patch.object(cache, "incr", side_effect=ConnectionError):
+            self.assertEqual(
+                [hit("test", "y", rate=(1, 60)) for _i in range(2)], [True, False]
+            )
+
+    @override_settings(AUTHLIB_THROTTLE_CACHE=None)
+    def test_memory_bound(self):
+        with patch("authlib.throttling.MEMORY_SIZE", 3):
+            for ident in "abcd":
+                hit("test", ident, rate=(1, 60))
+            self.assertLessEqual(len(_memory), 3)
+            # The oldest counter has been evicted
+            self.assertTrue(hit("test", "a", rate=(1, 60)))
+            self.assertFalse(hit("test", "d", rate=(1, 60)))
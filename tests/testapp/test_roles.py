@@ -1,11 +1,32 @@
 from functools import partial
 
+from django.contrib import admin
+from django.contrib.auth.models import Permission
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.exceptions import (
+    ImproperlyConfigured,
+    PermissionDenied,
+    ValidationError,
+)
 from django.test import TestCase
 from django.test.utils import override_settings
 from django.utils.translation import deactivate_all, gettext_lazy as _
 
-from authlib.little_auth.models import User
-from authlib.roles import allow_deny_globs
+from authlib.backends import (
+    PermissionsBackend,
+    _all_perms,
+    _role_matrix,
+    invalidate_permissions,
+)
+from authlib.little_auth.models import Role, User
+from authlib.roles import (
+    _registry,
+    _roles,
+    allow_deny_globs,
+    compile_allow_deny_globs,
+)
 
 
 @override_settings(
@@ -82,3 +103,410 @@ class Test(TestCase):
             role="unknown",
         )
         self.assertFalse(unknown.has_perm("sessions.change_session"))
+
+    def test_role_permissions_shared(self):
+        calls = []
+
+        def callback(*, user, perm, obj):
+            calls.append(perm)
+            return perm.startswith("sessions.")
+
+        with override_settings(
+            AUTHLIB_ROLES={"default": {"title": _("default"), "callback": callback}}
+        ):
+            first = User.objects.create(email="first@example.com")
+            second = User.objects.create(email="second@example.com")
+            inactive = User.objects.create(
+                email="inactive@example.com", is_active=False
+            )
+
+            self.assertTrue(first.has_perm("sessions.change_session"))
+            self.assertFalse(first.has_perm("little_auth.change_user"))
+            # Permissions are evaluated lazily
+            self.assertEqual(
+                calls, ["sessions.change_session", "little_auth.change_user"]
+            )
+            self.assertTrue(second.has_perm("sessions.change_session"))
+            self.assertEqual(len(calls), 2)
+
+            self.assertEqual(
+                second.get_all_permissions(),
+                {
+                    "sessions.add_session",
+                    "sessions.change_session",
+                    "sessions.delete_session",
+                    "sessions.view_session",
+                },
+            )
+            evaluated = len(calls)
+            self.assertEqual(evaluated, len(set(calls)))
+            self.assertFalse(inactive.has_perm("sessions.change_session"))
+            self.assertEqual(inactive.get_all_permissions(), set())
+            self.assertTrue(first.has_module_perms("sessions"))
+            # The role matrix is shared between all user instances
+            self.assertEqual(len(calls), evaluated)
+
+    def test_superuser_fast_path(self):
+        calls = []
+
+        def callback(*, user, perm, obj):
+            calls.append(perm)
+            return False
+
+        with override_settings(
+            AUTHLIB_ROLES={"default": {"title": _("default"), "callback": callback}}
+        ):
+            superuser = User.objects.create_superuser("admin@example.com", "blabla")
+            backend = PermissionsBackend()
+            self.assertEqual(
+                set(backend.get_all_permissions(superuser)), set(_all_perms())
+            )
+            self.assertTrue(backend.has_module_perms(superuser, "sessions"))
+            self.assertEqual(
+                backend.get_permissions_by_app(superuser)["sessions"],
+                {"session": {"add", "change", "delete", "view"}},
+            )
+            self.assertEqual(calls, [])
+
+    def test_role_permissions_current_user(self):
+        users = []
+
+        def callback(*, user, perm, obj):
+            users.append(user)
+            return False
+
+        with override_settings(
+            AUTHLIB_ROLES={"default": {"title": _("default"), "callback": callback}}
+        ):
+            # with_perm evaluates using an unsaved user instance
+            list(
+                User.objects.with_perm(
+                    "sessions.change_session",
+                    backend="authlib.backends.PermissionsBackend",
+                )
+            )
+            user = User.objects.create(email="user@example.com")
+            self.assertFalse(user.has_perm("sessions.view_session"))
+            self.assertIs(users[-1], user)
+
+            # The role matrix does not keep a reference to any user
+            users.clear()
+            self.assertFalse(user.has_module_perms("auth"))
+            self.assertEqual({id(u) for u in users}, {id(user)})
+
+    def test_shared_permissions_cache(self):
+        calls = []
+
+        def callback(*, user, perm, obj):
+            calls.append(perm)
+            return perm.startswith("sessions.")
+
+        with override_settings(
+            AUTHLIB_ROLES={"default": {"title": _("default"), "callback": callback}},
+            AUTHLIB_PERMISSIONS_CACHE="default",
+        ):
+            user = User.objects.create(email="user@example.com")
+            self.assertTrue(user.has_perm("sessions.change_session"))
+            evaluated = len(calls)
+
+            # Simulate another process with an empty role matrix
+            _role_matrix.clear()
+            user = User.objects.get()
+            self.assertTrue(user.has_perm("sessions.change_session"))
+            self.assertEqual(len(calls), evaluated)
+
+            invalidate_permissions()
+            user = User.objects.get()
+            self.assertTrue(user.has_perm("sessions.change_session"))
+            self.assertEqual(len(calls), 2 * evaluated)
+
+    def test_permissions_invalidated_on_change(self):
+        user = User.objects.create(email="user@example.com", role="deny_accounts")
+        self.assertNotIn("sessions.frobnicate_session", user.get_all_permissions())
+        self.assertNotIn("sessions.frobnicate_session", _all_perms())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            permission = Permission.objects.create(
+                content_type=ContentType.objects.get_for_model(Session),
+                codename="frobnicate_session",
+                name="Can frobnicate session",
+            )
+            self.assertNotIn("sessions.frobnicate_session", _all_perms())
+        self.assertIn("sessions.frobnicate_session", _all_perms())
+        user = User.objects.get()
+        self.assertIn("sessions.frobnicate_session", user.get_all_permissions())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            permission.delete()
+        self.assertNotIn("sessions.frobnicate_session", _all_perms())
+
+    def test_with_perm(self):
+        superuser = User.objects.create_superuser("admin@example.com", "blabla")
+        User.objects.create(email="default@example.com", role="default")
+        deny_accounts = User.objects.create(
+            email="deny@example.com", role="deny_accounts"
+        )
+        User.objects.create(
+            email="inactive@example.com", role="deny_accounts", is_active=False
+        )
+        backend = "authlib.backends.PermissionsBackend"
+
+        queryset = User.objects.with_perm("sessions.change_session", backend=backend)
+        with self.assertNumQueries(1):
+            self.assertEqual(set(queryset), {superuser, deny_accounts})
+
+        self.assertEqual(
+            set(
+                User.objects.with_perm(
+                    "sessions.change_session",
+                    backend=backend,
+                    include_superusers=False,
+                )
+            ),
+            {deny_accounts},
+        )
+        self.assertEqual(
+            set(User.objects.with_perm("little_auth.change_user", backend=backend)),
+            {superuser},
+        )
+        self.assertEqual(
+            set(
+                User.objects.with_perm(
+                    Permission.objects.get(codename="change_session"),
+                    backend=backend,
+                )
+            ),
+            {superuser, deny_accounts},
+        )
+        self.assertEqual(
+            list(
+                User.objects.with_perm(
+                    "sessions.change_session", backend=backend, obj=superuser
+                )
+            ),
+            [],
+        )
+
+    def test_permissions_by_app(self):
+        backend = PermissionsBackend()
+        default = User.objects.create(email="default@example.com", role="default")
+        deny_accounts = User.objects.create(
+            email="deny@example.com", role="deny_accounts"
+        )
+
+        self.assertFalse(default.has_module_perms("sessions"))
+        self.assertTrue(deny_accounts.has_module_perms("sessions"))
+        self.assertFalse(deny_accounts.has_module_perms("little_auth"))
+
+        self.assertEqual(backend.get_permissions_by_app(default), {})
+        summary = backend.get_permissions_by_app(deny_accounts)
+        self.assertEqual(
+            summary["sessions"], {"session": {"add", "change", "delete", "view"}}
+        )
+        self.assertNotIn("little_auth", summary)
+
+    def test_compile_allow_deny_globs(self):
+        rules = {
+            "allow": {
+                "sessions.*",
+                "auth.view_*",
+                "admin.add_logentry",
+                "*_user",
+                "shop.export.*",
+            },
+            "deny": {"little_auth.*", "auth.[cd]*"},
+        }
+        compiled = compile_allow_deny_globs(**rules)
+
+        def check(callback, perm):
+            try:
+                return callback(user=None, perm=perm, obj=None)
+            except PermissionDenied:
+                return None
+
+        perms = [
+            *_all_perms(),
+            "sessions",
+            "sessions.",
+            "auth.view_user",
+            "shop.export.csv",
+            "shop.export",
+            "shop.view_order",
+        ]
+        for perm in perms:
+            with self.subTest(perm=perm):
+                self.assertEqual(
+                    check(compiled, perm),
+                    check(partial(allow_deny_globs, **rules), perm),
+                )
+
+        self.assertTrue(check(compiled, "sessions.change_session"))
+        self.assertIsNone(check(compiled, "little_auth.change_user"))
+        self.assertFalse(check(compiled, "admin.change_logentry"))
+        # Codenames may contain dots
+        self.assertTrue(check(compiled, "shop.export.csv"))
+        self.assertTrue(check(compile_allow_deny_globs(allow={"*"}), "sessions"))
+
+    def test_role_registry(self):
+        roles = _roles()
+        self.assertIs(_roles(), roles)
+        self.assertEqual(list(roles), ["default", "deny_accounts"])
+        self.assertIsNone(roles["default"]["callback"])
+        # partial(allow_deny_globs, ...) is replaced with the compiled variant
+        self.assertEqual(
+            repr(roles["deny_accounts"]["callback"]),
+            repr(
+                compile_allow_deny_globs(
+                    allow={"*"},
+                    deny={"auth.*", "admin_sso.*", "accounts.*", "little_auth.*"},
+                )
+            ),
+        )
+        with self.assertRaises(TypeError):
+            roles["default"]["callback"] = None
+
+        with override_settings(AUTHLIB_ROLES={"other": {"title": "other"}}):
+            self.assertEqual(list(_roles()), ["other"])
+        self.assertIs(_roles()["default"]["callback"], None)
+
+        for roles in [{"broken": {}}, {"broken": {"title": "", "callback": 3}}]:
+            with (
+                self.subTest(roles=roles),
+                override_settings(AUTHLIB_ROLES=roles),
+                self.assertRaises(ImproperlyConfigured),
+            ):
+                _roles()
+
+    def test_role_inheritance(self):
+        roles = {
+            "viewer": {"title": "viewer", "allow": {"*.view_*"}},
+            "editor": {
+                "title": "editor",
+                "extends": ["viewer"],
+                "callback": partial(allow_deny_globs, allow={"sessions.*"}),
+            },
+            "manager": {
+                "title": "manager",
+                "extends": ["editor"],
+                "allow": {"admin.*"},
+                "deny": {"sessions.delete_*"},
+            },
+        }
+        with override_settings(AUTHLIB_ROLES=roles):
+            manager = _roles()["manager"]
+            self.assertEqual(manager["allow"], {"*.view_*", "sessions.*", "admin.*"})
+            self.assertEqual(manager["deny"], {"sessions.delete_*"})
+
+            user = User.objects.create(email="manager@example.com", role="manager")
+            self.assertTrue(user.has_perm("little_auth.view_user"))
+            self.assertTrue(user.has_perm("sessions.change_session"))
+            self.assertTrue(user.has_perm("admin.delete_logentry"))
+            self.assertFalse(user.has_perm("sessions.delete_session"))
+            self.assertFalse(user.has_perm("little_auth.change_user"))
+
+            user = User.objects.create(email="editor@example.com", role="editor")
+            self.assertTrue(user.has_perm("sessions.delete_session"))
+            self.assertFalse(user.has_perm("admin.delete_logentry"))
+
+        for roles in [
+            {
+                "a": {"title": "a", "extends": ["b"]},
+                "b": {"title": "b", "extends": ["a"]},
+            },
+            {"a": {"title": "a", "extends": ["unknown"]}},
+            {
+                "a": {"title": "a", "extends": ["b"]},
+                "b": {"title": "b", "callback": print},
+            },
+            {"a": {"title": "a", "allow": {"*"}, "callback": print}},
+        ]:
+            with (
+                self.subTest(roles=roles),
+                override_settings(AUTHLIB_ROLES=roles),
+                self.assertRaises(ImproperlyConfigured),
+            ):
+                _roles()
+
+    @override_settings(AUTHLIB_DATABASE_ROLES=True)
+    def test_database_roles(self):
+        cache.clear()
+        role = Role.objects.create(
+            key="sessions",
+            title="sessions",
+            allow="sessions.*\n*.view_*",
+            deny="sessions.delete_*",
+            extends="deny_accounts",
+        )
+        self.assertEqual(
+            [key for key, _title in User._meta.get_field("role").choices],
+            ["default", "deny_accounts", "sessions"],
+        )
+
+        user = User.objects.create(email="user@example.com", role="sessions")
+        self.assertTrue(user.has_perm("sessions.change_session"))
+        self.assertTrue(user.has_perm("admin.change_logentry"))
+        self.assertFalse(user.has_perm("sessions.delete_session"))
+        self.assertFalse(user.has_perm("little_auth.view_user"))
+
+        # Simulate another process; the roles are loaded from the cache
+        _registry.update(roles=None, shared=None, checked=None)
+        with self.assertNumQueries(0):
+            self.assertIn("sessions", _roles())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            role.deny = ""
+            role.save()
+            # The version is only bumped after committing the transaction
+            with self.assertNumQueries(0):
+                self.assertIn("sessions.delete_*", _roles()["sessions"]["deny"])
+        # The role query, wrapped in a savepoint
+        with self.assertNumQueries(3):
+            self.assertIn("sessions", _roles())
+        with self.assertNumQueries(0):
+            _roles()
+        user = User.objects.get()
+        self.assertTrue(user.has_perm("sessions.delete_session"))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            role.delete()
+        self.assertNotIn("sessions", _roles())
+        user = User.objects.get()
+        self.assertFalse(user.has_perm("sessions.change_session"))
+
+    @override_settings(AUTHLIB_DATABASE_ROLES=True)
+    def test_invalid_database_roles(self):
+        cache.clear()
+        base = Role.objects.create(key="base", title="base", allow="sessions.*")
+        Role.objects.create(key="child", title="child", extends="base")
+        base.extends = "child"
+        with self.assertRaisesRegex(ValidationError, "Circular role inheritance"):
+            base.full_clean()
+        with self.assertRaisesRegex(ValidationError, "unknown role 'typo'"):
+            Role(key="other", title="other", extends="typo").full_clean()
+        with self.assertRaisesRegex(ValidationError, "defined in the settings"):
+            Role(key="default", title="default").full_clean()
+        # Renaming a role which is extended by another role
+        base.extends = ""
+        base.key = "renamed"
+        with self.assertRaisesRegex(ValidationError, "unknown role 'base'"):
+            base.full_clean()
+
+        # Invalid rows saved without validation are skipped
+        base.key = "base"
+        base.extends = "child"
+        base.save()
+        Role.objects.create(key="typo", title="typo", extends="missing")
+        Role.objects.create(key="valid", title="valid", extends="deny_accounts")
+        with self.assertLogs("authlib.roles", "WARNING") as logs:
+            self.assertEqual(list(_roles()), ["default", "deny_accounts", "valid"])
+        self.assertEqual(len(logs.records), 3)
+        self.assertEqual(
+            [key for key, _title in User._meta.get_field("role").choices],
+            ["default", "deny_accounts", "valid"],
+        )
+        user = User.objects.create(email="user@example.com", role="base")
+        self.assertFalse(user.has_perm("sessions.view_session"))
+
+    def test_role_admin_registration(self):
+        # AUTHLIB_DATABASE_ROLES is off in the test settings
+        self.assertFalse(admin.site.is_registered(Role))
@@ -6,7 +6,11 @@ from authlib import views
 from authlib.facebook import FacebookOAuth2Client
 from authlib.google import GoogleOAuth2Client
 from authlib.twitter import TwitterOAuthClient
-from testapp.views import custom_verification, custom_verification_code
+from testapp.views import (
+    ExampleOIDCClient,
+    custom_verification,
+    custom_verification_code,
+)
 
 
 urlpatterns = [
@@ -32,6 +36,12 @@ urlpatterns = [
         {"client_class": TwitterOAuthClient},
         name="accounts_oauth_twitter",
     ),
+    path(
+        "oauth/oidc/",
+        views.oauth2,
+        {"client_class": ExampleOIDCClient},
+        name="accounts_oauth_oidc",
+    ),
     path("email/", views.email_registration, name="email_registration"),
     path(
         "email/<str:code>/",
@@ -2,6 +2,7 @@ from django.http import HttpResponse
 from django.shortcuts import render
 
 from authlib.email import decode
+from authlib.oidc import OIDCClient
 from authlib.views import EmailRegistrationForm
 
 
@@ -17,3 +18,9 @@ def custom_verification(request):
 def custom_verification_code(request, code):
     email, payload = decode(code, max_age=100)
     return HttpResponse(f"email:{email} payload:{payload}")
+
+
+class ExampleOIDCClient(OIDCClient):
+    issuer = "https://sso.example.com/realms/test"
+    client_id = "empty"
+    client_secret = "empty"